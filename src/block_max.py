@@ -0,0 +1,178 @@
+import numpy as np
+
+from compression import expand_ranges, sorted_unique
+from scoring import TOP_K, LINK_RANK_BOOST, base_scores, block_bounds, link_ranks, term_weights, top_k
+
+FIRST_BATCH = 16 # intervals scored in the first batch, doubled every batch after
+MAX_BATCH = 4096
+SHORT_BLOCKS = 128 # terms with at most this many blocks of postings have all their docs scored straight away
+
+
+def interval_bounds(term_blocks):
+    ''' Splits the docs at every block boundary of every term, so each interval of docs falls inside exactly one block per
+    term. Returns the (first doc, last doc) of every interval and the sum of the block upper bounds covering it '''
+    ends = sorted_unique(np.concatenate([last_docs for last_docs, _ in term_blocks])).astype(np.int64)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+
+    bounds = np.zeros(len(ends))
+    for last_docs, block_bounds in term_blocks:
+        block = np.searchsorted(last_docs, ends) # the block containing each interval
+        inside = block < len(last_docs)
+        bounds[inside] += block_bounds[block[inside]]
+
+    return starts, ends, bounds
+
+
+def containing_blocks(last_docs, docs):
+    ''' Sorted numbers of the blocks that would contain docs, by a term's block last docs '''
+    blocks = sorted_unique(np.searchsorted(last_docs, docs))
+    return blocks[blocks < len(last_docs)]
+
+
+def lookup_frequencies(frequencies, column, postings, candidate_docs):
+    ''' Fills a column of the candidate docs' frequency matrix by binary searching a term's postings for every candidate '''
+    docs, term_frequencies = postings
+    if not len(docs):
+        return
+
+    found = np.minimum(np.searchsorted(docs, candidate_docs), len(docs) - 1)
+    hit = docs[found] == candidate_docs
+    frequencies[hit, column] = term_frequencies[found[hit]]
+
+
+def candidate_frequencies(index, term_numbers, term_blocks, candidate_docs, found, absent=()):
+    ''' Frequency matrix of the sorted candidate docs with a column per term. found has the (docs, frequencies) of some
+    terms in every candidate, the rest get looked up in the blocks the candidates fall in, except the absent terms which
+    none of the candidates contain '''
+    frequencies = np.zeros((len(candidate_docs), len(term_numbers)))
+    for term, term_number in enumerate(term_numbers):
+        if term in found:
+            docs, term_frequencies = found[term]
+            frequencies[np.searchsorted(candidate_docs, docs), term] = term_frequencies
+        elif term not in absent:
+            blocks = containing_blocks(term_blocks[term][0], candidate_docs)
+            lookup_frequencies(frequencies, term, index.postings(term_number, blocks), candidate_docs)
+    return frequencies
+
+
+class top_docs:
+    ''' The k best docs scored so far. threshold is the k-th best final score once there are k, a doc that can't beat it
+    doesn't need scoring '''
+    def __init__(self, k, query_terms):
+        self.k = k
+        self.query_terms = query_terms
+        self.max_boost = 1 + LINK_RANK_BOOST * len(query_terms) # the most link_rank can multiply a score by
+        self.docs = np.zeros(0, dtype=np.int64)
+        self.scores = np.zeros(0)
+        self.details = {} # doc : [base_score, l_rank, rank_boost]
+        self.threshold = 0.0
+
+    def add(self, index, docs, scores):
+        ''' Boosts the base scores of docs and keeps the ones that make the top k '''
+        usable = index.doc_lengths[docs] > 0
+        keys, scores = docs[usable], scores[usable]
+        rank_boosts = index.rank_boosts[keys]
+        ranked_scores = scores * rank_boosts
+
+        # link_rank never lowers a score, so the batch's own k-th best score before it is also a floor for the final top k
+        floor = self.threshold
+        if len(ranked_scores) > self.k:
+            floor = max(floor, np.partition(ranked_scores, -self.k)[-self.k])
+        maybe = np.flatnonzero(ranked_scores * self.max_boost >= floor) # only these need their url looked up
+        urls = [index.url(key) for key in keys[maybe].tolist()]
+        l_rank = 1 + link_ranks(urls, self.query_terms)
+        final_scores = ranked_scores[maybe] * l_rank
+        for key, base_score, boost, rank_boost in zip(keys[maybe].tolist(), scores[maybe].tolist(), l_rank.tolist(), rank_boosts[maybe].tolist()):
+            self.details[key] = [base_score, boost, rank_boost]
+
+        self.docs = np.concatenate((self.docs, keys[maybe].astype(np.int64)))
+        self.scores = np.concatenate((self.scores, final_scores))
+        keep = top_k(self.scores, self.k)
+        self.docs, self.scores = self.docs[keep], self.scores[keep]
+        if len(self.scores) >= self.k:
+            self.threshold = self.scores[-1]
+
+    def results(self, index):
+        return [[index.url(doc), float(score), self.details[doc]] for doc, score in zip(self.docs.tolist(), self.scores.tolist())]
+
+
+def block_max_search(index, term_numbers, query_terms, terms, idf, ranker, k=TOP_K, bm25=None):
+    ''' Top k search of a disk_index with an additive ranker (not cosine, a cosine score isn't a sum of per term scores).
+    Terms with few postings go first: all their docs are scored, which usually sets a high threshold right away, and no
+    doc left can contain them. Intervals of docs are then scored in order of the other terms' block-max upper bound
+    (times the highest page rank boost in the interval), and the search stops as soon as the next interval's bound,
+    with the full link_rank boost, can't beat the k-th best score. Like MaxScore, terms whose bounds together can't beat
+    that score either only have their frequencies looked up for docs found through the other, essential terms, and once
+    few postings of those are left they're all scored at once instead of interval by interval. Only the compressed blocks
+    a batch falls in get decoded, so most of a common term's postings never are.
+    term_numbers are the index term numbers of terms (None if missing). Returns the same format as scoring.score_pages. '''
+    if not query_terms:
+        return []
+
+    weights = term_weights(ranker, query_terms, terms, idf)
+    present = [i for i, term_number in enumerate(term_numbers) if term_number is not None]
+    if not present:
+        return []
+
+    present_terms = [terms[i] for i in present]
+    present_numbers = [term_numbers[i] for i in present]
+    term_blocks = []
+    for i in present:
+        blocks = index.blocks(term_numbers[i])
+        term_blocks.append((blocks[0], block_bounds(ranker, weights[i], blocks, bm25)))
+
+    def score(candidate_docs, found, absent=()):
+        frequencies = candidate_frequencies(index, present_numbers, term_blocks, candidate_docs, found, absent)
+        lengths = np.maximum(index.doc_lengths[candidate_docs], 1).astype(np.float64) # top_docs drops the unusable ones
+        best.add(index, candidate_docs, base_scores(ranker, frequencies, lengths, query_terms, present_terms, idf[present], bm25))
+
+    best = top_docs(k, query_terms)
+    short = [term for term, (last_docs, _) in enumerate(term_blocks) if len(last_docs) <= SHORT_BLOCKS]
+    long = [term for term in range(len(present)) if term not in short]
+
+    short_docs = np.zeros(0, dtype=np.int64)
+    if short:
+        found = {term: index.postings(present_numbers[term]) for term in short}
+        short_docs = sorted_unique(np.concatenate([docs for docs, _ in found.values()])).astype(np.int64)
+        score(short_docs, found)
+    if not long:
+        return best.results(index)
+
+    starts, ends, bounds = interval_bounds([term_blocks[term] for term in long])
+    bounds = bounds * np.maximum.reduceat(index.rank_boosts, starts)
+    order = np.argsort(-bounds, kind="stable")
+
+    term_bounds = np.array([term_blocks[term][1].max() for term in long])
+    by_bound = np.argsort(term_bounds)
+
+    position = 0
+    batch_size = FIRST_BATCH
+    while position < len(order) and bounds[order[position]] * best.max_boost > best.threshold:
+        # a doc only containing the lowest bound terms can't make it if their bounds add up to less than the threshold
+        essential = [long[i] for i in by_bound[np.cumsum(term_bounds[by_bound]) * best.max_boost * index.max_rank_boost > best.threshold]]
+
+        drain = False
+        if len(essential) < len(long):
+            remaining = order[position:]
+            remaining_ends = ends[remaining[bounds[remaining] * best.max_boost > best.threshold]]
+            drain = sum(len(containing_blocks(term_blocks[term][0], remaining_ends)) for term in essential) <= SHORT_BLOCKS
+
+        if drain: # every doc that can still make it has an essential term, and there are few of those left
+            batch = order[position:]
+            position = len(order)
+        else:
+            batch = order[position:position + batch_size]
+            position += batch_size
+            batch_size = min(batch_size * 2, MAX_BATCH)
+        batch = batch[bounds[batch] * best.max_boost > best.threshold]
+
+        found = {}
+        for term in essential:
+            docs, term_frequencies = index.postings(present_numbers[term], containing_blocks(term_blocks[term][0], ends[batch]))
+            positions = expand_ranges(np.searchsorted(docs, starts[batch]), np.searchsorted(docs, ends[batch], side="right"))
+            unscored = positions[~np.isin(docs[positions], short_docs)]
+            found[term] = (docs[unscored], term_frequencies[unscored])
+
+        score(sorted_unique(np.concatenate([docs for docs, _ in found.values()])), found, absent=short)
+
+    return best.results(index)
@@ -0,0 +1,98 @@
+import numpy as np
+
+
+def expand_ranges(starts, ends):
+    ''' Concatenation of np.arange(start, end) for every start, end pair '''
+    lengths = ends - starts
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    return np.arange(lengths.sum()) + offsets
+
+
+def sorted_unique(values):
+    ''' np.unique for integers, sorting and dropping repeats is a lot faster than the hash table np.unique uses '''
+    values = np.sort(values)
+    return values[np.concatenate(([True], values[1:] != values[:-1]))] if len(values) else values
+
+
+def segment_cumsum(values, lengths):
+    ''' Running sums of values that restart at every segment, lengths are the segment lengths '''
+    totals = np.concatenate(([0], np.cumsum(values, dtype=np.int64)))
+    starts = np.cumsum(lengths) - lengths
+    return totals[1:] - np.repeat(totals[starts], lengths)
+
+
+def varint_sizes(values):
+    ''' Amount of bytes every value takes as a varint '''
+    values = np.asarray(values, dtype=np.uint64)
+    sizes = np.ones(len(values), dtype=np.int64)
+    for shift in range(7, 64, 7):
+        sizes += values >= (1 << shift)
+    return sizes
+
+
+def varint_encode(values):
+    ''' Encodes unsigned integers as varints: 7 bits per byte, low bits first, high bit set on every byte but the last '''
+    values = np.asarray(values, dtype=np.uint64)
+    sizes = varint_sizes(values)
+
+    within = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes) # which byte of its value each byte is
+    encoded = ((np.repeat(values, sizes) >> (7 * within).astype(np.uint64)) & 0x7f).astype(np.uint8)
+    encoded[within < np.repeat(sizes, sizes) - 1] |= 0x80
+    return encoded
+
+
+def varint_decode(data):
+    ''' Decodes a uint8 array of back to back varints into a uint64 array '''
+    data = np.asarray(data, dtype=np.uint8)
+    if not len(data):
+        return np.zeros(0, dtype=np.uint64)
+
+    ends = np.flatnonzero(data < 0x80)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    sizes = ends - starts + 1
+
+    # most values are a byte or two, so this loops over ever fewer values instead of shifting every byte
+    values = (data[starts] & 0x7f).astype(np.uint64)
+    longer = np.flatnonzero(sizes > 1)
+    for byte in range(1, 10):
+        if not len(longer):
+            break
+        values[longer] |= (data[starts[longer] + byte] & 0x7f).astype(np.uint64) << np.uint64(7 * byte)
+        longer = longer[sizes[longer] > byte + 1]
+    return values
+
+
+def encode_blocks(docs, frequencies, block_size):
+    ''' Compresses a term's sorted docs and their frequencies into blocks of block_size postings. Each block is the varint
+    gaps between its docs, the first one counted from the last doc of the block before (or 0), followed by the varint
+    frequencies. Returns the encoded bytes and the byte offset every block starts at. '''
+    docs = np.asarray(docs, dtype=np.int64)
+    gaps = np.diff(docs, prepend=0)
+
+    # lay every block out as its gaps followed by its frequencies
+    block_starts = np.arange(0, len(docs), block_size)
+    block_lengths = np.diff(block_starts, append=len(docs))
+    first = np.repeat(block_starts, block_lengths) + np.arange(len(docs)) # where each posting's gap goes
+    values = np.zeros(2 * len(docs), dtype=np.uint64)
+    values[first] = gaps
+    values[first + np.repeat(block_lengths, block_lengths)] = frequencies
+
+    sizes = varint_sizes(values)
+    block_sizes = np.add.reduceat(sizes, 2 * block_starts) if len(docs) else sizes
+    return varint_encode(values), (np.cumsum(block_sizes) - block_sizes).astype(np.uint64)
+
+
+def decode_blocks(data, block_lengths, block_bases):
+    ''' Decodes blocks made by encode_blocks back into (docs, frequencies). data is the blocks' bytes back to back,
+    block_lengths the amount of postings in every block and block_bases the last doc before every block (0 for a term's
+    first block) '''
+    block_lengths = np.asarray(block_lengths, dtype=np.int64)
+    values = varint_decode(data).astype(np.int64)
+
+    # every block is its gaps followed by its frequencies, the same layout encode_blocks makes
+    first = np.repeat(np.cumsum(block_lengths) - block_lengths, block_lengths) + np.arange(block_lengths.sum())
+    gaps = values[first]
+    frequencies = values[first + np.repeat(block_lengths, block_lengths)]
+
+    docs = np.repeat(np.asarray(block_bases, dtype=np.int64), block_lengths) + segment_cumsum(gaps, block_lengths)
+    return docs, frequencies
@@ -1,4 +1,6 @@
 import os
+from collections import Counter
+from datetime import datetime
 from urllib.parse import quote_plus
 
 import asyncpg
@@ -6,13 +8,13 @@ from asyncpg.exceptions import DeadlockDetectedError
 import asyncio
 import sqlalchemy as sa
 from dotenv import load_dotenv
-from sqlalchemy import (Column, ForeignKey, Integer, Table, exists, select,
+from sqlalchemy import (Column, ForeignKey, Index, Integer, Table, exists, select,
                         update)
-from sqlalchemy.dialects.postgresql import ARRAY, INTEGER, TEXT, insert, asyncpg
+from sqlalchemy.dialects.postgresql import ARRAY, BIGINT, DOUBLE_PRECISION, INTEGER, SMALLINT, TEXT, TIMESTAMP, insert, asyncpg, aggregate_order_by
 from sqlalchemy.exc import DBAPIError
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import (Mapped, backref, declarative_base, mapped_column,
-                            relationship, selectinload, sessionmaker, load_only)
+                            relationship, sessionmaker, load_only)
 from sqlalchemy.sql import func
 
 import time
@@ -33,16 +35,45 @@ term_links = Table(
     Base.metadata,
     Column("term_id", INTEGER, ForeignKey("terms.term_id"), primary_key=True),
     Column("page_id", INTEGER, ForeignKey("pages.page_id"), primary_key=True),
+    Column("frequency", INTEGER, nullable=False, server_default="1"),
+    Column("positions", ARRAY(INTEGER), nullable=True), # delta encoded term positions, only stored when indexing with positions
+    Index("term_page_links_page_id", "page_id"), # to find a re-crawled page's old links
     schema = 'public'
     )
 
 
+LINK_COLUMNS = ("term_id", "page_id", "frequency", "positions") # order of the values in add_chunk's tuples
+
+
+# create_all only creates missing tables, so columns added after a database was first made are added here
+SCHEMA_UPGRADES = [
+    "ALTER TABLE public.term_page_links ADD COLUMN IF NOT EXISTS frequency INTEGER NOT NULL DEFAULT 1",
+    "ALTER TABLE public.pages ADD COLUMN IF NOT EXISTS page_length INTEGER",
+    "ALTER TABLE public.index_stats ADD COLUMN IF NOT EXISTS generation BIGINT NOT NULL DEFAULT 0",
+    "ALTER TABLE public.term_page_links ADD COLUMN IF NOT EXISTS positions INTEGER[]",
+    "ALTER TABLE public.pages ADD COLUMN IF NOT EXISTS page_rank DOUBLE PRECISION",
+    "ALTER TABLE public.pages ADD COLUMN IF NOT EXISTS content_updated TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()",
+    "ALTER TABLE public.pages ADD COLUMN IF NOT EXISTS indexed_at TIMESTAMP WITH TIME ZONE",
+    "CREATE INDEX IF NOT EXISTS term_page_links_page_id ON public.term_page_links (page_id)",
+    "ALTER TABLE public.pages ADD COLUMN IF NOT EXISTS simhash BIGINT",
+    "ALTER TABLE public.pages ADD COLUMN IF NOT EXISTS duplicate_of INTEGER",
+    "ALTER TABLE public.pages ADD COLUMN IF NOT EXISTS simhash_version SMALLINT",
+]
+
+
 class Page(Base):
     __tablename__ = "pages"
 
     page_id: Mapped[int] = mapped_column(primary_key=True, index=True, unique=True)
     page_url: Mapped[str] = mapped_column(TEXT, unique=True)
     page_content: Mapped[str] = mapped_column(TEXT, nullable=True) 
+    page_length: Mapped[int] = mapped_column(INTEGER, nullable=True) # amount of indexed terms, set by the indexer
+    page_rank: Mapped[float] = mapped_column(DOUBLE_PRECISION, nullable=True) # relative to the average page (1), set by page_rank.py
+    content_updated: Mapped[datetime] = mapped_column(TIMESTAMP(timezone=True), server_default=func.now()) # last time the crawler changed the content
+    indexed_at: Mapped[datetime] = mapped_column(TIMESTAMP(timezone=True), nullable=True) # start of the indexer run that last indexed the page
+    simhash: Mapped[int] = mapped_column(BIGINT, nullable=True) # content fingerprint, set by the indexer
+    duplicate_of: Mapped[int] = mapped_column(INTEGER, nullable=True) # page_id of the page this one is a near duplicate of, which gets indexed instead
+    simhash_version: Mapped[int] = mapped_column(SMALLINT, nullable=True) # version of the simhash function that made the fingerprint
 
     outlinks = relationship(
         "Page",
@@ -77,6 +108,28 @@ class Term(Base):
     )
 
 
+class IndexStats(Base):
+    __tablename__ = "index_stats"
+
+    stats_id: Mapped[int] = mapped_column(primary_key=True) # only ever one row
+    total_pages: Mapped[int] = mapped_column(BIGINT)
+    total_length: Mapped[int] = mapped_column(BIGINT)
+    generation: Mapped[int] = mapped_column(BIGINT, server_default="0") # bumped every time the indexer finishes a run
+
+
+class IndexLease(Base):
+    ''' A range of page ids for one indexer node to work on during a sharded run '''
+    __tablename__ = "index_leases"
+
+    lease_id: Mapped[int] = mapped_column(primary_key=True)
+    start_id: Mapped[int] = mapped_column(INTEGER) # first and last page_id of the range, inclusive
+    end_id: Mapped[int] = mapped_column(INTEGER)
+    owner: Mapped[str] = mapped_column(TEXT, nullable=True) # node that holds it, or last held it
+    expires_at: Mapped[datetime] = mapped_column(TIMESTAMP(timezone=True), nullable=True) # anyone can take it over after this
+    attempts: Mapped[int] = mapped_column(INTEGER, server_default="0")
+    done_at: Mapped[datetime] = mapped_column(TIMESTAMP(timezone=True), nullable=True)
+
+
 async def connect_to_db(request_pool_size):
     '''Loads database and tables, returns a session object'''
     load_dotenv()
@@ -92,6 +145,8 @@ async def connect_to_db(request_pool_size):
     Session = sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        for upgrade in SCHEMA_UPGRADES:
+            await conn.execute(sa.text(upgrade))
 
     return Session
 
@@ -210,7 +265,12 @@ async def add_batch(session_maker, page_batch, max_params):
 
     chunk = sorted([{"page_url": item.url, "page_content": item.content} for item in page_batch], key=lambda x: x['page_url'])
 
-    in_stmt = insert(Page).on_conflict_do_update(index_elements=["page_url"], set_={"page_content": insert(Page).excluded.page_content})
+    # pages whose content actually changed are picked up again by the next incremental indexer run
+    page_insert = insert(Page)
+    content_changed = Page.page_content.is_distinct_from(page_insert.excluded.page_content)
+    in_stmt = page_insert.on_conflict_do_update(index_elements=["page_url"],
+                                                set_={"page_content": page_insert.excluded.page_content,
+                                                      "content_updated": sa.case((content_changed, func.now()), else_=Page.content_updated)})
     inserted_pages = await run_transaction_safely(session_maker, transaction_func=insert_pages, args=[in_stmt, chunk, urls])
     total_sucessful_inserts = len(inserted_pages)
 
@@ -288,6 +348,15 @@ async def insert_links(session, stmt, chunk):
     await session.commit()
 
 # ----------------- FOR INDEXER  -----------------
+async def get_term_ids(session, batch_size):
+    ''' Streams (term, term_id) for every term, used to fill the indexer's term dictionary at startup '''
+    stmt = select(Term.term, Term.term_id).execution_options(yield_per=batch_size)
+    result = await session.stream(stmt)
+
+    async for batch in result.partitions():
+        yield batch
+
+
 async def insert_terms(session, in_stmt, chunk, terms):
     ''' Inserts terms and gets their ids '''
     await session.execute(in_stmt, chunk)
@@ -319,38 +388,254 @@ async def insert_terms_safe(session_maker, term_info, max_params):
 
 
 async def add_chunk(session, chunk):
-    ''' Add a chunk of term-page links '''
-    stmt = insert(term_links).on_conflict_do_nothing(index_elements=[term_links.c.term_id, term_links.c.page_id])
-    await session.execute(stmt, chunk, execution_options={"postgresql_executemany": True})
+    ''' Bulk loads a chunk of (term_id, page_id, frequency[, positions]) link tuples: COPY into a temporary staging table,
+    then one INSERT ... SELECT merges them in key order, overwriting the frequency (and positions) of links that already
+    exist. Every merge takes its row locks in the same order, so concurrent merges don't deadlock. Doesn't commit. '''
+    columns = LINK_COLUMNS[:len(chunk[0])]
+    await session.execute(sa.text("CREATE TEMPORARY TABLE IF NOT EXISTS term_links_staging "
+                                  "(LIKE public.term_page_links INCLUDING DEFAULTS) ON COMMIT DELETE ROWS"))
+
+    # COPY needs the asyncpg connection under the session, it runs in the same transaction
+    connection = await (await session.connection()).get_raw_connection()
+    await connection.driver_connection.copy_records_to_table("term_links_staging", records=chunk, columns=columns)
+
+    column_list = ", ".join(columns)
+    overwrite = ", ".join(f"{column} = EXCLUDED.{column}" for column in columns[2:])
+    await session.execute(sa.text(f"INSERT INTO public.term_page_links ({column_list}) "
+                                  f"SELECT {column_list} FROM term_links_staging ORDER BY term_id, page_id "
+                                  f"ON CONFLICT (term_id, page_id) DO UPDATE SET {overwrite}"))
+
+
+async def write_page_batch(session, page_ids, chunk, term_deltas, indexed_at):
+    ''' Writes an indexed page batch in one transaction: removes the links of the pages' old content, adds their new links
+    (chunk, see add_chunk), applies term_deltas (term_id : pages added) less the removed links to total_pages and marks the
+    pages indexed at indexed_at. So a crash never leaves links in without their counts, or pages marked indexed without
+    their links. Pages an earlier run found to be duplicates of these are marked not indexed, their canonical page might
+    have changed so the next incremental run checks them again. '''
+    term_deltas = Counter(term_deltas)
+    if page_ids:
+        for term_id, removed in await remove_page_links(session, page_ids):
+            term_deltas[term_id] -= removed
+    if chunk:
+        await add_chunk(session, chunk)
+    await apply_term_deltas(session, term_deltas)
+    await session.execute(update(Page).where(Page.page_id == sa.any_(sa.literal(page_ids, ARRAY(INTEGER)))).values(indexed_at=indexed_at))
+    await session.execute(update(Page).where(Page.duplicate_of == sa.any_(sa.literal(page_ids, ARRAY(INTEGER))),
+                                             Page.indexed_at < indexed_at).values(indexed_at=None))
     await session.commit()
 
 
-async def add_chunk_safe(session_maker, chunk):
-    ''' Add a chunk of term-page links safely '''
-    await run_transaction_safely(session_maker, transaction_func=add_chunk, args=[chunk])
+async def write_page_batch_safe(session_maker, page_ids, chunk, term_deltas, indexed_at):
+    await run_transaction_safely(session_maker, transaction_func=write_page_batch, args=[sorted(page_ids), chunk, term_deltas, indexed_at])
+
+
+async def clear_term_links(session_maker):
+    ''' Empties term_page_links and zeroes every term's total_pages, before the offline build loads every link again. Every
+    page is marked as not indexed until the build is done, so an interrupted build gets redone by the next run. '''
+    async with session_maker() as session:
+        await session.execute(sa.text("TRUNCATE public.term_page_links"))
+        await session.execute(update(Term).values(total_pages=0))
+        await session.execute(update(Page).values(indexed_at=None))
+        await session.commit()
+
+
+async def copy_links(session, chunk, term_deltas):
+    ''' COPYs link tuples straight into term_page_links, only for links that can't exist yet (after clear_term_links),
+    and adds term_deltas (term_id : links copied) to total_pages in the same transaction '''
+    connection = await (await session.connection()).get_raw_connection()
+    await connection.driver_connection.copy_records_to_table("term_page_links", schema_name="public", records=chunk,
+                                                             columns=LINK_COLUMNS[:len(chunk[0])])
+    await apply_term_deltas(session, term_deltas)
+    await session.commit()
+
 
+async def copy_links_safe(session_maker, chunk, term_deltas):
+    await run_transaction_safely(session_maker, transaction_func=copy_links, args=[chunk, term_deltas])
 
-async def get_pages(session, batch_size):    
-    ''' Gets all availible pages in a stream and returns them as an async generator object '''
-    stmt = select(Page).where(Page.page_content != None).execution_options(yield_per=batch_size)
-    result = await session.stream_scalars(stmt)
-    batch = []
 
-    async for page in result:
-        batch.append([page.page_id, page.page_content])
+async def set_page_lengths(session, chunk):
+    ''' Sets the page_length column for a chunk of pages '''
+    await session.execute(update(Page), chunk)
+    await session.commit()
 
-        if len(batch) >= batch_size:
-            yield batch
-            batch = []
 
-    if batch:
+async def set_page_lengths_safe(session_maker, page_lengths):
+    ''' Writes a dictionary of page_id : page_length to the database safely '''
+    chunk = sorted([{"page_id": p_id, "page_length": length} for p_id, length in page_lengths.items()], key=lambda x: x["page_id"]) #sort to avoid sharelocks
+    if chunk:
+        await run_transaction_safely(session_maker, transaction_func=set_page_lengths, args=[chunk])
+
+
+async def get_pages(session, batch_size, incremental=False, after=None, until=None, fetch_size=None):
+    ''' Streams (page_id, page_content) of every page with content in page_id order, in batches of batch_size. Only the two
+    columns are read through a server side cursor that fetches fetch_size rows at a time (batch_size by default), so no Page
+    objects or their links get loaded. incremental only gets pages that were never indexed or changed since they last were,
+    after skips every page up to and including that page_id and until stops after that page_id (a sharded run's lease) '''
+    stmt = select(Page.page_id, Page.page_content).where(Page.page_content != None)
+    if incremental:
+        stmt = stmt.where(sa.or_(Page.indexed_at == None, Page.content_updated > Page.indexed_at))
+    if after is not None:
+        stmt = stmt.where(Page.page_id > after)
+    if until is not None:
+        stmt = stmt.where(Page.page_id <= until)
+    stmt = stmt.order_by(Page.page_id).execution_options(yield_per=fetch_size or batch_size)
+    result = await session.stream(stmt)
+
+    async for batch in result.partitions(batch_size):
         yield batch
 
     print("Got all pages")
 
 
+async def get_fingerprints(session, batch_size, version):
+    ''' Streams (page_id, simhash) of every page that isn't a duplicate with a fingerprint of this simhash version, to fill
+    the indexer's simhash_index. Pages fingerprinted by an older version are left out until they are indexed again. '''
+    stmt = (select(Page.page_id, Page.simhash)
+            .where(Page.simhash != None, Page.duplicate_of == None, Page.simhash_version == version)
+            .execution_options(yield_per=batch_size))
+    result = await session.stream(stmt)
+
+    async for batch in result.partitions():
+        yield batch
+
+
+async def set_fingerprints(session, page_ids, fingerprints, duplicates, version):
+    ''' Sets simhash, its version and duplicate_of for a chunk of pages, as arrays like set_page_ranks '''
+    stmt = sa.text("UPDATE public.pages SET simhash = prints.simhash, duplicate_of = prints.duplicate_of, simhash_version = :version "
+                   "FROM unnest(CAST(:page_ids AS INTEGER[]), CAST(:fingerprints AS BIGINT[]), CAST(:duplicates AS INTEGER[])) "
+                   "AS prints(page_id, simhash, duplicate_of) WHERE pages.page_id = prints.page_id")
+    await session.execute(stmt, {"page_ids": page_ids, "fingerprints": fingerprints, "duplicates": duplicates, "version": version})
+    await session.commit()
+
+
+async def set_fingerprints_safe(session_maker, fingerprints, duplicates, version):
+    ''' Writes a dictionary of page_id : simhash (or None) made by that simhash version and one of page_id : canonical
+    page_id for the duplicates among them '''
+    page_ids = sorted(fingerprints) #sort to avoid sharelocks
+    if page_ids:
+        await run_transaction_safely(session_maker, transaction_func=set_fingerprints,
+                                     args=[page_ids, [fingerprints[page_id] for page_id in page_ids], [duplicates.get(page_id) for page_id in page_ids], version])
+
+
+# ----------------- FOR SHARDED INDEXING -----------------
+LEASE_LOCK = 4815162342 # advisory lock key for creating and finishing the leases of a run
+
+
+async def create_leases(session_maker, lease_pages, incremental=False):
+    ''' Splits the pages to index into leases of lease_pages pages, unless a run is already going (then its leases are
+    joined). Returns the amount of leases created, 0 if there was nothing to index, or None if a run was joined. '''
+    async with session_maker() as session:
+        await session.execute(select(func.pg_advisory_xact_lock(LEASE_LOCK)))
+        if (await session.execute(select(exists().select_from(IndexLease)))).scalar_one():
+            await session.commit()
+            return None
+
+        page_filter = "page_content IS NOT NULL"
+        if incremental:
+            page_filter += " AND (indexed_at IS NULL OR content_updated > indexed_at)"
+        result = await session.execute(sa.text(
+            "INSERT INTO public.index_leases (start_id, end_id) "
+            "SELECT min(page_id), max(page_id) FROM "
+            f"(SELECT page_id, (row_number() OVER (ORDER BY page_id) - 1) / :lease_pages AS lease FROM public.pages WHERE {page_filter}) AS numbered "
+            "GROUP BY lease ORDER BY lease"), {"lease_pages": lease_pages})
+        await session.commit()
+        return result.rowcount
+
+
+async def claim_lease(session, owner, ttl):
+    ''' Takes the first lease nobody holds (never taken or expired) for ttl seconds. SKIP LOCKED lets nodes claim at the
+    same time without waiting on each other. Returns (lease_id, start_id, end_id, attempts) or None when there is nothing left '''
+    stmt = sa.text("UPDATE public.index_leases SET owner = :owner, expires_at = now() + make_interval(secs => :ttl), attempts = attempts + 1 "
+                   "WHERE lease_id = (SELECT lease_id FROM public.index_leases "
+                   "WHERE done_at IS NULL AND (expires_at IS NULL OR expires_at < now()) "
+                   "ORDER BY start_id LIMIT 1 FOR UPDATE SKIP LOCKED) "
+                   "RETURNING lease_id, start_id, end_id, attempts")
+    result = await session.execute(stmt, {"owner": owner, "ttl": ttl})
+    lease = result.one_or_none()
+    await session.commit()
+    return lease
+
+
+async def renew_lease(session, lease_id, owner, ttl):
+    ''' Extends a lease that is still held by owner, returns False if it expired and was taken over '''
+    stmt = (update(IndexLease)
+            .where(IndexLease.lease_id == lease_id, IndexLease.owner == owner, IndexLease.done_at == None)
+            .values(expires_at=func.now() + func.make_interval(0, 0, 0, 0, 0, 0, ttl)))
+    result = await session.execute(stmt)
+    await session.commit()
+    return result.rowcount == 1
+
+
+async def complete_lease(session, lease_id, owner):
+    stmt = update(IndexLease).where(IndexLease.lease_id == lease_id, IndexLease.owner == owner).values(done_at=func.now())
+    result = await session.execute(stmt)
+    await session.commit()
+    return result.rowcount == 1
+
+
+async def finish_leases(session_maker):
+    ''' Ends the run once every lease is done, by removing them. Only one node gets to, it gets back whether any lease
+    was retried after a node lost it. Everyone else (or anyone while leases are left) gets None. '''
+    async with session_maker() as session:
+        await session.execute(select(func.pg_advisory_xact_lock(LEASE_LOCK)))
+        stmt = sa.text("DELETE FROM public.index_leases WHERE NOT EXISTS "
+                       "(SELECT 1 FROM public.index_leases WHERE done_at IS NULL) RETURNING attempts")
+        attempts = (await session.execute(stmt)).scalars().all()
+        await session.commit()
+        return max(attempts) > 1 if attempts else None
+
+
+async def count_open_leases(session):
+    ''' Amount of leases that aren't done, 0 once a run is finished and its leases removed '''
+    stmt = select(func.count()).select_from(IndexLease).where(IndexLease.done_at == None)
+    return (await session.execute(stmt)).scalar_one()
+
+
+async def get_db_time(session):
+    result = await session.execute(select(func.now()))
+    return result.scalar_one()
+
+
+async def remove_page_links(session, page_ids):
+    ''' Deletes every term link of the given pages (the links of re-crawled pages' old content), returns (term_id, amount
+    of links removed) for every term that lost some. Doesn't commit. '''
+    stmt = sa.text("WITH removed AS (DELETE FROM public.term_page_links WHERE page_id = ANY(CAST(:page_ids AS INTEGER[])) RETURNING term_id) "
+                   "SELECT term_id, count(*) FROM removed GROUP BY term_id")
+    result = await session.execute(stmt, {"page_ids": page_ids})
+    return result.all()
+
+
+async def apply_term_deltas(session, term_deltas):
+    ''' Adds a dictionary of term_id : change in total_pages to the terms, instead of recounting them. The rows are locked
+    in term_id order first, so concurrent batches wait on each other instead of deadlocking. Doesn't commit. '''
+    changed = sorted((term_id, delta) for term_id, delta in term_deltas.items() if delta)
+    if not changed:
+        return
+
+    term_ids, deltas = [term_id for term_id, _ in changed], [delta for _, delta in changed]
+    await session.execute(sa.text("SELECT term_id FROM public.terms WHERE term_id = ANY(CAST(:term_ids AS INTEGER[])) "
+                                  "ORDER BY term_id FOR NO KEY UPDATE"), {"term_ids": term_ids})
+    stmt = sa.text("UPDATE public.terms SET total_pages = terms.total_pages + deltas.delta "
+                   "FROM unnest(CAST(:term_ids AS INTEGER[]), CAST(:deltas AS INTEGER[])) AS deltas(term_id, delta) "
+                   "WHERE terms.term_id = deltas.term_id")
+    await session.execute(stmt, {"term_ids": term_ids, "deltas": deltas})
+
+
+async def set_pages_indexed(session, page_ids, indexed_at):
+    await session.execute(update(Page).where(Page.page_id == sa.any_(sa.literal(page_ids, ARRAY(INTEGER)))).values(indexed_at=indexed_at))
+    await session.commit()
+
+
+async def set_pages_indexed_safe(session_maker, page_ids, indexed_at, chunk_size=50000):
+    ''' Marks pages as indexed by the run that started at indexed_at '''
+    page_ids = sorted(page_ids)
+    for start in range(0, len(page_ids), chunk_size):
+        await run_transaction_safely(session_maker, transaction_func=set_pages_indexed, args=[page_ids[start:start + chunk_size], indexed_at])
+
+
 async def set_term_counts(session_maker):
-    ''' Sets the total_page column for all terms, ran after program has finished executing '''
+    ''' Recounts the total_pages column of every term from term_page_links. The indexer keeps it up to date with
+    apply_term_deltas, so this is only needed to repair the counts '''
     print("Updating total_pages")
     async with session_maker() as session:
         count_stmt = select(func.count()).select_from(term_links).where(term_links.c.term_id == Term.term_id).scalar_subquery()
@@ -359,8 +644,99 @@ async def set_term_counts(session_maker):
         await session.execute(stmt)
         await session.commit()
     print("Updated total pages!")
+
+
+async def set_index_stats(session_maker):
+    ''' Stores the amount of indexed pages and their summed length once per run, so queries don't need to aggregate pages.
+    Also publishes a new index generation, which tells query engines their cached results are stale '''
+    async with session_maker() as session:
+        result = await session.execute(select(func.count(), func.coalesce(func.sum(Page.page_length), 0)).where(Page.page_length != None))
+        total_pages, total_length = result.one()
+
+        stmt = insert(IndexStats).values(stats_id=1, total_pages=total_pages, total_length=total_length, generation=1)
+        stmt = stmt.on_conflict_do_update(index_elements=[IndexStats.stats_id],
+                                          set_={"total_pages": stmt.excluded.total_pages, "total_length": stmt.excluded.total_length,
+                                                "generation": IndexStats.generation + 1})
+        await session.execute(stmt)
+        await session.commit()
             
 
+# ----------------- FOR INDEX EXPORT -----------------
+async def get_index_docs(session, batch_size):
+    ''' Streams (page_id, page_url, page_length, page_rank) for every indexed page in page_id order, in batches of batch_size '''
+    stmt = (select(Page.page_id, Page.page_url, Page.page_length, Page.page_rank)
+            .where(Page.page_length != None)
+            .order_by(Page.page_id)
+            .execution_options(yield_per=batch_size))
+    result = await session.stream(stmt)
+
+    async for batch in result.partitions():
+        yield batch
+
+
+async def get_index_postings(session, batch_size, positions=False):
+    ''' Streams (term, page_ids, frequencies) for every term in byte order of the term, with page_ids sorted. With positions
+    there is also a list of every page's delta encoded positions as comma separated text, since postgres can't aggregate
+    arrays of different lengths (empty for links stored without positions) '''
+    columns = [Term.term,
+               func.array_agg(aggregate_order_by(term_links.c.page_id, term_links.c.page_id)),
+               func.array_agg(aggregate_order_by(term_links.c.frequency, term_links.c.page_id))]
+    if positions:
+        position_text = func.coalesce(func.array_to_string(term_links.c.positions, ","), "")
+        columns.append(func.array_agg(aggregate_order_by(position_text, term_links.c.page_id)))
+
+    stmt = (select(*columns)
+            .join(term_links, term_links.c.term_id == Term.term_id)
+            .group_by(Term.term)
+            .order_by(Term.term.collate("C"))
+            .execution_options(yield_per=batch_size))
+    result = await session.stream(stmt)
+
+    async for batch in result.partitions():
+        yield batch
+
+
+async def has_positions(session):
+    ''' Whether any term-page link was stored with positions '''
+    result = await session.execute(select(exists().where(term_links.c.positions != None)))
+    return result.scalar_one()
+
+
+# ----------------- FOR PAGE RANK -----------------
+async def get_page_ranks(session, batch_size):
+    ''' Streams (page_id, page_rank) for every page in page_id order, page_rank is None for pages that don't have one yet '''
+    stmt = select(Page.page_id, Page.page_rank).order_by(Page.page_id).execution_options(yield_per=batch_size)
+    result = await session.stream(stmt)
+
+    async for batch in result.partitions():
+        yield batch
+
+
+async def get_page_links(session, batch_size):
+    ''' Streams every (source_page_id, outgoing_page_id) link between pages '''
+    stmt = select(page_links.c.source_page_id, page_links.c.outgoing_page_id).execution_options(yield_per=batch_size)
+    result = await session.stream(stmt)
+
+    async for batch in result.partitions():
+        yield batch
+
+
+async def set_page_ranks(session, page_ids, page_ranks):
+    ''' Sets page_rank for a chunk of pages, sent as two arrays so a chunk is one statement with two parameters '''
+    stmt = sa.text("UPDATE public.pages SET page_rank = ranks.page_rank "
+                   "FROM unnest(CAST(:page_ids AS INTEGER[]), CAST(:page_ranks AS DOUBLE PRECISION[])) AS ranks(page_id, page_rank) "
+                   "WHERE pages.page_id = ranks.page_id")
+    await session.execute(stmt, {"page_ids": page_ids, "page_ranks": page_ranks})
+    await session.commit()
+
+
+async def set_page_ranks_safe(session_maker, page_ids, page_ranks, chunk_size=50000):
+    ''' Writes page ranks to the database safely, chunk_size pages per transaction '''
+    for start in range(0, len(page_ids), chunk_size):
+        chunk = [page_ids[start:start + chunk_size], page_ranks[start:start + chunk_size]]
+        await run_transaction_safely(session_maker, transaction_func=set_page_ranks, args=chunk)
+
+
 # ----------------- FOR QUERY ENGINE -----------------
 async def count_pages(session):
     stmt = select(func.count()).select_from(Page).where(Page.page_content != None)
@@ -368,6 +744,30 @@ async def count_pages(session):
     return result.scalar_one_or_none()
 
 
+async def get_index_stats(session):
+    ''' Gets (total_pages, average_length) as stored by the indexer, or None if the indexer hasn't stored them yet '''
+    result = await session.execute(select(IndexStats.total_pages, IndexStats.total_length).where(IndexStats.stats_id == 1))
+    stats = result.one_or_none()
+    if not stats:
+        return None
+
+    total_pages, total_length = stats
+    return total_pages, total_length / max(total_pages, 1)
+
+
+async def bump_index_generation(session_maker):
+    ''' Publishes a new index generation without recounting the stats, for jobs that change rankings outside the indexer '''
+    async with session_maker() as session:
+        await session.execute(update(IndexStats).where(IndexStats.stats_id == 1).values(generation=IndexStats.generation + 1))
+        await session.commit()
+
+
+async def get_index_generation(session):
+    ''' Gets the index generation published by the last indexer run, 0 if there hasn't been one '''
+    result = await session.execute(select(IndexStats.generation).where(IndexStats.stats_id == 1))
+    return result.scalar_one_or_none() or 0
+
+
 async def get_total_pages_for_terms(session, terms):
     set_terms = set(terms)
     stmt = select(Term.term, Term.total_pages).where(Term.term.in_(set_terms))
@@ -376,16 +776,26 @@ async def get_total_pages_for_terms(session, terms):
     return result.all()
 
 
-async def retrieve_term_pages(session, term_str):
-    stmt = select(Term).where(Term.term == term_str).options(selectinload(Term.pages))
+async def retrieve_postings(session, terms):
+    ''' Gets (term, page_id, page_url, page_length, page_rank, frequency) for every page containing any of the terms in one
+    query, ordered by term and page_id. Only the needed columns are selected, so no page content or links get loaded '''
+    stmt = (select(Term.term, Page.page_id, Page.page_url, Page.page_length, Page.page_rank, term_links.c.frequency)
+            .join(term_links, term_links.c.term_id == Term.term_id)
+            .join(Page, Page.page_id == term_links.c.page_id)
+            .where(Term.term.in_(set(terms)))
+            .order_by(Term.term, Page.page_id))
     result = await session.execute(stmt)
-    term = result.scalar_one_or_none()
-    
-    items = []
-    if term:
-        for page in term.pages:
-            items.append((page.page_url, page.page_content))
 
-    return items
+    return result.all()
+
 
- 
\ No newline at end of file
+async def retrieve_positions(session, terms, page_ids):
+    ''' Gets (term, page_id, positions) for the given terms in the given pages, ordered by term and page_id. positions are
+    delta encoded, or None for links stored without them '''
+    stmt = (select(Term.term, term_links.c.page_id, term_links.c.positions)
+            .join(term_links, term_links.c.term_id == Term.term_id)
+            .where(Term.term.in_(set(terms)), term_links.c.page_id == sa.any_(sa.literal(list(page_ids), ARRAY(INTEGER)))) # one array parameter however many pages
+            .order_by(Term.term, term_links.c.page_id))
+    result = await session.execute(stmt)
+
+    return result.all()
@@ -0,0 +1,396 @@
+import asyncio
+import json
+import mmap
+import os
+import shutil
+import struct
+import time
+from contextlib import ExitStack
+from tempfile import TemporaryFile
+
+import numpy as np
+
+from db import connect_to_db, get_index_docs, get_index_postings, has_positions
+from scoring import bm25_params, bm25_tf, page_rank_boosts
+from positions import decode_keys
+from compression import decode_blocks, encode_blocks, expand_ranges, sorted_unique
+
+DEFAULT_INDEX_PATH = "index.bin"
+
+MAGIC = b"ISRCHIDX"
+VERSION = 6
+HEADER = struct.Struct("<8sII") # magic, version, amount of sections
+SECTION = struct.Struct("<16sQQ") # name, offset, size in bytes
+ALIGNMENT = 8
+BLOCK_SIZE = 64 # postings per compressed block and block-max upper bound
+SPILLED_SECTIONS = ("post_data", "post_starts", "block_last_docs", "block_max_tf", "block_max_bm25", "block_max_freq", "block_min_length",
+                    "pos_counts", "positions")
+
+
+def align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def section_size(data):
+    if isinstance(data, np.ndarray):
+        return data.nbytes
+    if isinstance(data, bytes):
+        return len(data)
+    data.seek(0, os.SEEK_END) # temporary file
+    return data.tell()
+
+
+def write_section(f, data):
+    if isinstance(data, np.ndarray):
+        f.write(data.tobytes())
+    elif isinstance(data, bytes):
+        f.write(data)
+    else:
+        data.seek(0)
+        shutil.copyfileobj(data, f)
+
+
+def write_index(path, sections):
+    ''' Writes a dictionary of section name : data (numpy arrays, bytes or temporary files) to an index file. The file is
+    written next to path and then moved over it, so readers never see a half written index. '''
+    table = []
+    offset = align(HEADER.size + SECTION.size * len(sections))
+    for name, data in sections.items():
+        if len(name.encode()) > 16: # the length of the name field in SECTION
+            raise ValueError(f"Section name {name} is too long")
+        size = section_size(data)
+        table.append((name, offset, size))
+        offset = align(offset + size)
+
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(table)))
+        for name, offset, size in table:
+            f.write(SECTION.pack(name.encode(), offset, size))
+
+        for name, offset, size in table:
+            f.write(b"\0" * (offset - f.tell()))
+            write_section(f, sections[name])
+
+    os.replace(temp_path, path)
+
+
+def parse_positions(position_texts):
+    ''' Turns the comma separated position lists from get_index_postings into an array of position counts and one array of
+    every delta, concatenated '''
+    counts = np.array([text.count(",") + 1 if text else 0 for text in position_texts], dtype=np.uint32)
+    if not counts.any():
+        return counts, np.zeros(0, dtype=np.uint32)
+    return counts, np.array(",".join(text for text in position_texts if text).split(","), dtype=np.uint32)
+
+
+def pack_strings(strings):
+    ''' Packs a list of strings into one utf-8 blob and an array of offsets into it '''
+    encoded = [string.encode() for string in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.uint64)
+    np.cumsum([len(item) for item in encoded], out=offsets[1:])
+    return offsets, b"".join(encoded)
+
+
+def pack_positions(position_lists):
+    ''' The same as parse_positions, for lists of delta encoded positions instead of text '''
+    counts = np.array([len(deltas) for deltas in position_lists], dtype=np.uint32)
+    if not counts.any():
+        return counts, np.zeros(0, dtype=np.uint32)
+    return counts, np.concatenate([deltas for deltas in position_lists if deltas]).astype(np.uint32)
+
+
+class index_writer:
+    ''' Builds an index file one term at a time, terms have to be added in byte order. Sections with an entry per posting
+    or per block are spilled to temporary files as they're made, so only the per term and per page arrays stay in memory.
+    Used by export_index and the indexer's offline build. '''
+
+    def __init__(self, doc_ids, doc_lengths, doc_ranks, urls, positions):
+        self.doc_ids = np.array(doc_ids, dtype=np.int64)
+        self.doc_lengths = np.array(doc_lengths, dtype=np.uint32)
+        self.doc_ranks = np.array(doc_ranks, dtype=np.float32) # None (no page rank yet) becomes nan
+        self.url_offsets, self.url_blob = pack_strings(urls)
+        self.positions = positions
+
+        self.total_length = int(self.doc_lengths.sum())
+        self.default_bm25 = bm25_params(self.total_length / max(len(self.doc_ids), 1))
+
+        self.terms, self.term_df, self.posting_offsets, self.block_offsets, self.position_offsets = [], [], [0], [0], [0]
+        self.post_data_size = 0
+
+        self.stack = ExitStack()
+        self.spilled = {name: self.stack.enter_context(TemporaryFile()) for name in SPILLED_SECTIONS}
+
+
+    def find_docs(self, page_ids):
+        ''' Turns sorted page ids into doc numbers, returns the docs and a mask of which page ids are indexed pages '''
+        page_ids = np.asarray(page_ids, dtype=np.int64)
+        docs = np.searchsorted(self.doc_ids, page_ids)
+        found = docs < len(self.doc_ids)
+        found[found] = self.doc_ids[docs[found]] == page_ids[found]
+        return docs[found].astype(np.uint32), found
+
+
+    def add_term(self, term, docs, frequencies, counts=None, deltas=None):
+        ''' Adds a term's postings, docs are sorted doc numbers. counts and deltas are its positions, as parse_positions gives '''
+        spilled = self.spilled
+        frequencies = np.asarray(frequencies, dtype=np.uint32)
+        data, data_offsets = encode_blocks(docs, frequencies, BLOCK_SIZE)
+        spilled["post_data"].write(data.tobytes())
+        spilled["post_starts"].write((data_offsets + self.post_data_size).tobytes())
+        self.post_data_size += len(data)
+
+        # upper bounds for block-max pruning, one for every block of BLOCK_SIZE postings
+        lengths = np.maximum(self.doc_lengths[docs], 1)
+        block_starts = np.arange(0, len(docs), BLOCK_SIZE)
+        spilled["block_last_docs"].write(docs[np.minimum(block_starts + BLOCK_SIZE, len(docs)) - 1].tobytes())
+        spilled["block_max_tf"].write(np.maximum.reduceat(frequencies / lengths, block_starts).tobytes())
+        spilled["block_max_bm25"].write(np.maximum.reduceat(bm25_tf(frequencies, lengths, self.default_bm25), block_starts).tobytes())
+        spilled["block_max_freq"].write(np.maximum.reduceat(frequencies, block_starts).tobytes())
+        spilled["block_min_length"].write(np.minimum.reduceat(lengths, block_starts).tobytes())
+
+        if self.positions:
+            spilled["pos_counts"].write(counts.tobytes())
+            spilled["positions"].write(deltas.tobytes())
+            self.position_offsets.append(self.position_offsets[-1] + len(deltas))
+
+        self.terms.append(term)
+        self.term_df.append(len(docs))
+        self.posting_offsets.append(self.posting_offsets[-1] + len(docs))
+        self.block_offsets.append(self.block_offsets[-1] + len(block_starts))
+
+
+    def write(self, path):
+        ''' Writes the index file and drops the spilled sections '''
+        with self.stack:
+            self.spilled["post_starts"].write(np.array([self.post_data_size], dtype=np.uint64).tobytes()) # where the last block ends
+            term_offsets, term_blob = pack_strings(self.terms)
+            meta = {"documents": len(self.doc_ids), "terms": len(self.terms), "postings": self.posting_offsets[-1], "block_size": BLOCK_SIZE,
+                    "total_length": self.total_length, "positions": self.positions, "created": time.time()}
+
+            write_index(path, {
+                "meta": json.dumps(meta).encode(),
+                "doc_ids": self.doc_ids,
+                "doc_lengths": self.doc_lengths,
+                "doc_ranks": self.doc_ranks,
+                "url_offsets": self.url_offsets,
+                "urls": self.url_blob,
+                "term_offsets": term_offsets,
+                "terms": term_blob,
+                "term_df": np.array(self.term_df, dtype=np.uint32),
+                "post_offsets": np.array(self.posting_offsets, dtype=np.uint64),
+                "block_offsets": np.array(self.block_offsets, dtype=np.uint64),
+                "pos_offsets": np.array(self.position_offsets, dtype=np.uint64),
+                **self.spilled,
+            })
+
+
+    def close(self):
+        self.stack.close()
+
+
+async def get_index_writer(session_maker, positions, batch_size=5000):
+    ''' Makes an index_writer for every page that has a length in the database, in page_id order '''
+    doc_ids, doc_lengths, doc_ranks, urls = [], [], [], []
+    async with session_maker() as session:
+        async for batch in get_index_docs(session, batch_size):
+            for page_id, page_url, page_length, page_rank in batch:
+                doc_ids.append(page_id)
+                doc_lengths.append(page_length)
+                doc_ranks.append(page_rank)
+                urls.append(page_url)
+
+    return index_writer(doc_ids, doc_lengths, doc_ranks, urls, positions)
+
+
+async def export_index(session_maker, path, batch_size=5000):
+    ''' Reads every indexed page and term-page link from the database and writes them to a binary index file at path.
+    Pages are numbered 0..n in page_id order, and postings refer to those numbers. '''
+    t = time.perf_counter()
+
+    async with session_maker() as session:
+        positions = await has_positions(session)
+    writer = await get_index_writer(session_maker, positions, batch_size)
+
+    try:
+        async with session_maker() as session:
+            async for batch in get_index_postings(session, batch_size, positions):
+                for term, page_ids, frequencies, *position_texts in batch:
+                    docs, found = writer.find_docs(page_ids) # links to pages without a length are dropped
+                    if not found.any():
+                        continue
+
+                    counts = deltas = None
+                    if positions:
+                        counts, deltas = parse_positions([text for text, keep in zip(position_texts[0], found) if keep])
+                    writer.add_term(term, docs, np.array(frequencies, dtype=np.uint32)[found], counts, deltas)
+
+        writer.write(path)
+    finally:
+        writer.close()
+
+    print(f"Exported {len(writer.doc_ids)} pages and {len(writer.terms)} terms to {path} in {time.perf_counter() - t}")
+
+
+class disk_index:
+    ''' Read only, memory mapped view of an index file written by export_index. Opening it only parses the section table,
+    everything else is read straight from the page cache when it is used. '''
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, section_amount = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not an index file")
+        if version != VERSION:
+            raise ValueError(f"{path} is index version {version}, expected version {VERSION}")
+
+        self.sections = {}
+        for i in range(section_amount):
+            name, offset, size = SECTION.unpack_from(self.mm, HEADER.size + i * SECTION.size)
+            self.sections[name.rstrip(b"\0").decode()] = (offset, size)
+
+        self.meta = json.loads(self.mm[slice(*self.section_range("meta"))])
+
+        self.doc_ids = self.array("doc_ids", np.int64)
+        self.doc_lengths = self.array("doc_lengths", np.uint32)
+        self.doc_ranks = self.array("doc_ranks", np.float32)
+        self.url_offsets = self.array("url_offsets", np.uint64)
+        self.term_offsets = self.array("term_offsets", np.uint64)
+        self.term_df = self.array("term_df", np.uint32)
+        self.post_offsets = self.array("post_offsets", np.uint64)
+        self.post_data = self.array("post_data", np.uint8)
+        self.post_starts = self.array("post_starts", np.uint64) # where every block starts in post_data
+        self.block_offsets = self.array("block_offsets", np.uint64)
+        self.block_last_docs = self.array("block_last_docs", np.uint32)
+        self.block_max_tf = self.array("block_max_tf", np.float64)
+        self.block_max_bm25 = self.array("block_max_bm25", np.float64) # with the default k1 and b
+        self.block_max_freq = self.array("block_max_freq", np.uint32)
+        self.block_min_length = self.array("block_min_length", np.uint32)
+        self.pos_offsets = self.array("pos_offsets", np.uint64) # per term, only filled if the index has positions
+        self.pos_counts = self.array("pos_counts", np.uint32) # per posting
+        self.positions = self.array("positions", np.uint32)
+
+        self.urls_start = self.sections["urls"][0]
+        self.terms_start = self.sections["terms"][0]
+
+        self.total_pages = len(self.doc_ids)
+        self.average_length = self.meta["total_length"] / max(self.total_pages, 1)
+        self.term_amount = len(self.term_df)
+        self.has_positions = self.meta["positions"]
+        self.rank_boosts = page_rank_boosts(self.doc_ranks)
+        self.max_rank_boost = float(self.rank_boosts.max()) if self.total_pages else 1.0
+
+
+    def section_range(self, name):
+        offset, size = self.sections[name]
+        return offset, offset + size
+
+
+    def array(self, name, dtype):
+        offset, size = self.sections[name]
+        return np.frombuffer(self.mm, dtype=dtype, count=size // np.dtype(dtype).itemsize, offset=offset)
+
+
+    def term_at(self, i):
+        start = self.terms_start + int(self.term_offsets[i])
+        end = self.terms_start + int(self.term_offsets[i + 1])
+        return self.mm[start:end]
+
+
+    def find_term(self, term):
+        ''' Binary searches the sorted term dictionary, returns the term's number or None '''
+        key = term.encode()
+        low, high = 0, self.term_amount
+        while low < high:
+            middle = (low + high) // 2
+            if self.term_at(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+
+        if low < self.term_amount and self.term_at(low) == key:
+            return low
+        return None
+
+
+    def postings(self, term_number, blocks=None):
+        ''' Decodes (docs, frequencies) for a term number. blocks are sorted block numbers within the term to only decode
+        those (every block by default), the term's block_last_docs work as skip pointers to find the blocks needed '''
+        first_block = int(self.block_offsets[term_number])
+        if blocks is None:
+            blocks = np.arange(int(self.block_offsets[term_number + 1]) - first_block)
+        blocks = np.asarray(blocks, dtype=np.int64)
+        if not len(blocks):
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+        term_blocks = first_block + blocks
+        starts = self.post_starts[term_blocks].astype(np.int64)
+        ends = self.post_starts[term_blocks + 1].astype(np.int64)
+        if blocks[-1] - blocks[0] + 1 == len(blocks): # a run of blocks is one slice of the file
+            data = self.post_data[starts[0]:ends[-1]]
+        else:
+            data = self.post_data[expand_ranges(starts, ends)]
+
+        lengths = np.minimum(BLOCK_SIZE, int(self.term_df[term_number]) - blocks * BLOCK_SIZE)
+        bases = np.zeros(len(blocks), dtype=np.int64) # each block's gaps start from the last doc of the block before
+        has_before = blocks > 0
+        bases[has_before] = self.block_last_docs[term_blocks[has_before] - 1]
+        return decode_blocks(data, lengths, bases)
+
+
+    def blocks(self, term_number):
+        ''' Returns (last_docs, max_tfs, max_bm25_tfs, max_frequencies, min_lengths) of a term's blocks of postings, all views
+        into the mapped file '''
+        start, end = int(self.block_offsets[term_number]), int(self.block_offsets[term_number + 1])
+        return (self.block_last_docs[start:end], self.block_max_tf[start:end], self.block_max_bm25[start:end],
+                self.block_max_freq[start:end], self.block_min_length[start:end])
+
+
+    def position_keys(self, term_number, docs):
+        ''' Decodes a term's positions in the given sorted docs into positions.decode_keys keys '''
+        last_docs = self.blocks(term_number)[0]
+        blocks = sorted_unique(np.searchsorted(last_docs, docs))
+        blocks = blocks[blocks < len(last_docs)]
+        term_docs, _ = self.postings(term_number, blocks)
+
+        # the number of every decoded posting within the term, to find its positions
+        lengths = np.minimum(BLOCK_SIZE, int(self.term_df[term_number]) - blocks * BLOCK_SIZE)
+        posting_numbers = np.repeat(blocks * BLOCK_SIZE - (np.cumsum(lengths) - lengths), lengths) + np.arange(len(term_docs))
+
+        hit = np.minimum(np.searchsorted(term_docs, docs), max(len(term_docs) - 1, 0))
+        hit = hit[term_docs[hit] == docs] if len(term_docs) else hit[:0]
+        found = posting_numbers[hit]
+
+        post_start = int(self.post_offsets[term_number])
+        counts = self.pos_counts[post_start:int(self.post_offsets[term_number + 1])].astype(np.int64)
+        starts = int(self.pos_offsets[term_number]) + np.cumsum(counts) - counts
+
+        deltas = self.positions[expand_ranges(starts[found], starts[found] + counts[found])]
+        return decode_keys(term_docs[hit], counts[found], deltas)
+
+
+    def url(self, doc):
+        start = self.urls_start + int(self.url_offsets[doc])
+        end = self.urls_start + int(self.url_offsets[doc + 1])
+        return self.mm[start:end].decode()
+
+
+    def close(self):
+        # numpy views keep the mmap exported, drop them before closing it
+        self.doc_ids = self.doc_lengths = self.doc_ranks = self.url_offsets = self.term_offsets = None
+        self.term_df = self.post_offsets = self.post_data = self.post_starts = None
+        self.block_offsets = self.block_last_docs = self.block_max_tf = self.block_max_bm25 = self.block_max_freq = self.block_min_length = None
+        self.pos_offsets = self.pos_counts = self.positions = None
+        self.mm.close()
+
+
+async def main():
+    session_maker = await connect_to_db(2)
+    await export_index(session_maker, os.getenv("INDEX_PATH", DEFAULT_INDEX_PATH))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,77 @@
+import heapq
+import os
+import pickle
+from itertools import groupby
+
+import numpy as np
+
+MAX_MERGE_RUNS = 200 # runs merged at once, more than that get merged into bigger runs first so open files stay bounded
+READ_BUFFER = 1 << 16
+
+
+def write_run(path, term_data, term_positions=None):
+    ''' Writes process_chunk's output to path as a sorted run: one (term, page_ids, frequencies, positions) record per term
+    in byte order of the term, with page_ids sorted and positions None when they aren't kept '''
+    with open(path, "wb") as f:
+        for term in sorted(term_data):
+            pages = sorted(term_data[term].items())
+            page_ids = [page_id for page_id, _ in pages]
+            positions = [term_positions[term][page_id] for page_id in page_ids] if term_positions is not None else None
+            pickle.dump((term, page_ids, [frequency for _, frequency in pages], positions), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def read_run(path):
+    ''' Streams the records of a run back, one term at a time '''
+    with open(path, "rb", buffering=READ_BUFFER) as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+
+def merge_records(records):
+    ''' Joins the records of one term from several runs into one, sorted by page id '''
+    if len(records) == 1:
+        return records[0]
+
+    term = records[0][0]
+    page_ids = np.concatenate([np.asarray(record[1], dtype=np.int64) for record in records])
+    frequencies = np.concatenate([np.asarray(record[2], dtype=np.int64) for record in records])
+    order = np.argsort(page_ids, kind="stable") # runs aren't in page id order, their pages are
+    positions = None
+    if records[0][3] is not None:
+        all_positions = [deltas for record in records for deltas in record[3]]
+        positions = [all_positions[i] for i in order]
+    return term, page_ids[order].tolist(), frequencies[order].tolist(), positions
+
+
+def merge_runs(paths):
+    ''' K-way merges sorted runs, yields one (term, page_ids, frequencies, positions) record per term in byte order '''
+    merged = heapq.merge(*(read_run(path) for path in paths), key=lambda record: record[0])
+    for _, records in groupby(merged, key=lambda record: record[0]):
+        yield merge_records(list(records))
+
+
+def compact_runs(paths, run_dir):
+    ''' Merges runs into bigger runs until there are at most MAX_MERGE_RUNS of them, removing the merged ones '''
+    generation = 0
+    while len(paths) > MAX_MERGE_RUNS:
+        merged_paths = []
+        for i in range(0, len(paths), MAX_MERGE_RUNS):
+            group = paths[i:i + MAX_MERGE_RUNS]
+            if len(group) == 1:
+                merged_paths.extend(group)
+                continue
+
+            path = os.path.join(run_dir, f"merged_{generation}_{i}.run")
+            with open(path, "wb") as f:
+                for record in merge_runs(group):
+                    pickle.dump(record, f, protocol=pickle.HIGHEST_PROTOCOL)
+            for old_path in group:
+                os.remove(old_path)
+            merged_paths.append(path)
+
+        paths = merged_paths
+        generation += 1
+    return paths
@@ -1,19 +1,34 @@
 import asyncio
 import time
-import re
 from io import StringIO
-from collections import Counter
+from collections import Counter, deque
 import traceback
 import os
 from concurrent.futures import ProcessPoolExecutor
 import random
+import socket
+from itertools import chain, repeat
+from tempfile import TemporaryDirectory
 
 from dataclasses import dataclass
 
+import numpy as np
+
 from queues import queue
-from db import connect_to_db, get_pages, insert_terms_safe, add_chunk_safe, set_term_counts
+from disk_index import DEFAULT_INDEX_PATH, export_index, get_index_writer, pack_positions
+from index_runs import compact_runs, merge_runs, write_run
+from page_transfer import read_shared_pages, share_pages
+from simhash import SIMHASH_VERSION, simhash, simhash_index
+from terms import index_terms
+from positions import delta_encode
+from db import (connect_to_db, get_pages, get_term_ids, insert_terms_safe, write_page_batch_safe, set_page_lengths_safe, set_index_stats,
+                get_db_time, get_fingerprints, create_leases, claim_lease, renew_lease, complete_lease, finish_leases, count_open_leases, set_term_counts, set_fingerprints_safe, set_pages_indexed_safe, clear_term_links, copy_links_safe)
 
 MAX_PARAMS = 14000
+COPY_ROWS = 100000 # term-page links per COPY
+RUN_PAGES = 2000 # pages per sorted run in offline builds
+LEASE_PAGES = 50000 # pages per lease in sharded runs
+LEASE_TTL = 300 # seconds a lease is held without being renewed before another node can take it over
 
 
 @dataclass
@@ -23,67 +38,403 @@ class page_info:
     content: str
 
 
+@dataclass
+class chunk_terms:
+    ''' process_chunk's results as flat arrays with an entry per term-page link, sorted by term. A lot cheaper to send back
+    from a worker process than dictionaries of dictionaries. '''
+    terms: list # every term of the chunk once, term_numbers index into it
+    term_numbers: np.ndarray
+    page_ids: np.ndarray
+    frequencies: np.ndarray
+    page_lengths: dict
+    fingerprints: dict # page_id : simhash, None for pages too short to fingerprint
+    position_counts: np.ndarray = None # amount of positions of every link, only with positions
+    position_deltas: np.ndarray = None # every link's delta encoded positions, concatenated
+
+    def link_positions(self):
+        ''' Every link's delta encoded positions as a list '''
+        return [deltas.tolist() for deltas in np.split(self.position_deltas, np.cumsum(self.position_counts)[:-1])]
+
+
 class index_handler:
     ''' Class that handles everything related to indexing. Reads from page table, finds all terms, adds them to the
     term table and connects term ids to page ids '''
-    def __init__(self, workers):
+    def __init__(self, workers, index_path=DEFAULT_INDEX_PATH, positions=False, incremental=False, dedupe=True):
         self.worker_num = workers
+        self.index_path = index_path # where the query engine's index file is exported to, None to skip exporting
+        self.positions = positions # store term positions for phrase and proximity queries, makes the index a lot bigger
+        self.incremental = incremental # only index new and re-crawled pages, also how an interrupted run is resumed
+        self.dedupe = dedupe # skip pages that are near duplicates of an already indexed page
+
+        self.simhashes = simhash_index() # fingerprints of every indexed page that isn't a duplicate
+        self.duplicates = set() # page_ids skipped as duplicates this run
+
+        self.term_ids = {} # term : term_id for every term in the database, shared by the term_insert_workers
+        self.indexed_pages = [] # pages built into runs by an offline build, marked indexed once all of it is loaded
+        self.run_start = None # indexed_at of the pages this run indexes, pages changed after it get indexed again next run
 
         with open("stopwords.txt", "r") as f:
             self.stopwords = set([word.strip() for word in f.readlines()])
 
         self.adding_new_pages = True
-        self.still_inserting = True
         self.current_insert_user = None
 
         self.page_chunks = asyncio.Queue(self.worker_num * 10)
         self.insert_chunks = asyncio.Queue(self.worker_num * 10)
 
         self.loop = asyncio.get_running_loop()
-        self.pool = ProcessPoolExecutor(max_workers=self.worker_num)
+        self.pool = ProcessPoolExecutor(max_workers=self.worker_num, initializer=init_worker, initargs=(self.stopwords,))
 
         self.indexed = 0
         self.batch_size = 750 #increase with amount of memory available on machine
 
         self.batch_requests = 0
         self.condition = asyncio.Condition()
+        self.dedupe_order = asyncio.Condition() # batches are checked for duplicates in page_id order, so the first copy is kept
+        self.next_batch = 0
         self.semaphore = asyncio.Semaphore(max(2, self.worker_num // 3))
 
         self.term_workers = []
         self.term_link_workers = []
+        self.term_worker_num = max(1, self.worker_num // 2)
+        self.lease_lost = False
 
 
     async def run_indexer(self):
         ''' Runs the indexer. Initalizes all workers. '''
 
         session_maker = await connect_to_db(self.worker_num) 
+        async with session_maker() as session:
+            self.run_start = await get_db_time(session)
+            await self.load_term_ids(session)
+            if self.dedupe:
+                await self.load_fingerprints(session)
+
+        await self.run_pipeline(session_maker)
+
+        await set_index_stats(session_maker)
+
+        if self.index_path:
+            await export_index(session_maker, self.index_path)
+        print("All done!")
+
+
+    async def run_pipeline(self, session_maker, after=None, until=None):
+        ''' Runs the page getter, term insert and term link insert workers over the pages after..until (every page by
+        default) until all of their links are written. If a worker fails the others are stopped and its exception raised,
+        the pages it didn't finish aren't marked indexed so the next incremental run picks them up. Cancelling it cancels
+        every worker, a write in progress is rolled back. '''
+        self.adding_new_pages = True
+        self.batch_requests = 0
+        self.next_batch = 0
+        self.page_chunks = asyncio.Queue(self.worker_num * 10) # new queues, a cancelled run can leave batches in the old ones
+        self.insert_chunks = asyncio.Queue(self.worker_num * 10)
 
-        self.term_workers = [asyncio.create_task(self.term_insert_worker(session_maker, i)) for i in range(self.worker_num // 2)]  
-        self.term_workers.append(asyncio.create_task(self.page_getter(session_maker, batch_size=self.batch_size)))
+        self.term_workers = [asyncio.create_task(self.term_insert_worker(session_maker, i)) for i in range(self.term_worker_num)]
+        self.term_workers.append(asyncio.create_task(self.page_getter(session_maker, self.batch_size, after, until)))
 
         self.term_link_workers = [asyncio.create_task(self.term_link_insert_worker(session_maker)) for _ in range(self.worker_num)]
-        
+
+        async def finish_term_workers():
+            await asyncio.gather(*self.term_workers)
+            for _ in self.term_link_workers: # every link is queued, tell the db workers they can exit
+                await self.insert_chunks.put(None)
+
         try:
-            await asyncio.gather(*self.term_workers, *self.term_link_workers)      
+            await asyncio.gather(finish_term_workers(), *self.term_link_workers)
         except asyncio.exceptions.CancelledError:
             pass
+        except Exception:
+            for task in chain(self.term_workers, self.term_link_workers):
+                task.cancel()
+            raise
+
+
+    async def run_sharded(self, node_name=None, lease_pages=LEASE_PAGES, lease_ttl=LEASE_TTL, max_wait=None):
+        ''' Runs as one of several indexer nodes splitting a run through the index_leases table, start it on every node.
+        Each node claims ranges of page ids until none are left and marks a range done once all of its batches are written.
+        A node that stops renewing its lease (crashed) has its range taken over once the lease expires, so nodes without a
+        range keep checking every lease_ttl until every range is done. Term ids always come from the terms table, so every
+        node agrees on them. The first node to see every range done ends the run.
+        Returns "finished" on the node that ended the run (or found nothing to index), "finished elsewhere" on the others,
+        or "unfinished" if ranges were still held by other nodes after waiting max_wait seconds (None waits until they are
+        done). '''
+        node_name = node_name or f"{socket.gethostname()}-{os.getpid()}"
+        session_maker = await connect_to_db(self.worker_num)
+        async with session_maker() as session:
+            self.run_start = await get_db_time(session)
+            await self.load_term_ids(session)
+            if self.dedupe:
+                await self.load_fingerprints(session)
+
+        created = await create_leases(session_maker, lease_pages, self.incremental)
+        if created is None:
+            print("Joining the leases of a running run")
+        else:
+            print(f"Created {created} leases" if created else "Nothing to index, finishing the run here")
+
+        waited = 0
+        retried = False
+        while created != 0: # with no leases there are no other nodes to wait for
+            async with session_maker() as session:
+                lease = await claim_lease(session, node_name, lease_ttl)
+            if lease is None:
+                retried = await finish_leases(session_maker)
+                if retried is not None:
+                    break
+
+                async with session_maker() as session:
+                    open_leases = await count_open_leases(session)
+                if open_leases == 0:
+                    print("Another node finished the run")
+                    return "finished elsewhere"
+                if max_wait is not None and waited >= max_wait:
+                    print(f"Gave up waiting on {open_leases} leases held by other nodes, the run is unfinished")
+                    return "unfinished"
+
+                print(f"Waiting on {open_leases} leases held by other nodes, taking them over if they expire")
+                await asyncio.sleep(lease_ttl)
+                waited += lease_ttl
+                continue
 
-        await set_term_counts(session_maker)
+            lease_id, start_id, end_id, attempts = lease
+            print(f"{node_name} claimed page_id {start_id} to {end_id}" + (f", attempt {attempts}" if attempts > 1 else ""))
+            self.lease_lost = False
+            pipeline = asyncio.create_task(self.run_pipeline(session_maker, after=start_id - 1, until=end_id))
+            heartbeat = asyncio.create_task(self.keep_lease(session_maker, lease_id, node_name, lease_ttl, pipeline))
+            try:
+                await pipeline
+            finally:
+                heartbeat.cancel()
+
+            if self.lease_lost: # another node is redoing the range, the run ends with a recount
+                print(f"Lost the lease on page_id {start_id} to {end_id}")
+            else:
+                async with session_maker() as session:
+                    await complete_lease(session, lease_id, node_name)
+
+        if retried: # a range was redone after a node lost it part way, so its deltas can't be trusted
+            await set_term_counts(session_maker)
+        await set_index_stats(session_maker)
+        if self.index_path:
+            await export_index(session_maker, self.index_path)
+        print("All done!")
+        return "finished"
+
+
+    async def keep_lease(self, session_maker, lease_id, owner, ttl, pipeline):
+        ''' Renews a lease every third of its ttl until cancelled. If it expired and was taken over, sets lease_lost and
+        cancels the pipeline working on its range, so it doesn't keep writing pages the new owner is writing too '''
+        while True:
+            await asyncio.sleep(ttl / 3)
+            async with session_maker() as session:
+                if not await renew_lease(session, lease_id, owner, ttl):
+                    self.lease_lost = True
+                    pipeline.cancel()
+                    return
+
+
+    async def run_offline(self, load_database=True, run_dir=None):
+        ''' Rebuilds the whole index without writing links to the database page batch by page batch. The process pool
+        writes every batch to a sorted run on disk (run_dir, or the system temp dir), then the runs are merged into the final
+        postings in one pass, which are COPYed into term_page_links (with load_database) and written to the index file. '''
+        session_maker = await connect_to_db(self.worker_num)
+        async with session_maker() as session:
+            run_start = await get_db_time(session)
+            await self.load_term_ids(session)
+
+        t = time.time()
+        with TemporaryDirectory(dir=run_dir) as run_dir:
+            run_paths = await self.build_runs(session_maker, run_dir)
+            run_paths = await asyncio.to_thread(compact_runs, run_paths, run_dir)
+            print(f"Wrote {len(run_paths)} runs in {time.time() - t}")
+
+            writer = await get_index_writer(session_maker, self.positions) if self.index_path else None
+            try:
+                if load_database:
+                    await clear_term_links(session_maker)
+                await self.load_merged(session_maker, merge_runs(run_paths), writer, load_database)
+                if writer:
+                    writer.write(self.index_path)
+            finally:
+                if writer:
+                    writer.close()
+        print(f"Merged runs in {time.time() - t}")
+
+        if load_database:
+            await set_pages_indexed_safe(session_maker, self.indexed_pages, run_start)
+        await set_index_stats(session_maker)
         print("All done!")
 
 
-    async def page_getter(self, session_maker, batch_size):
-        ''' Feeds batches of pages of batch_size length to the page_chunks queue, only adding new batches to the
-        queue when term_insert_workers request for an add.'''
+    async def build_runs(self, session_maker, run_dir):
+        ''' Sends every page batch to build_run in the process pool, with at most one batch per worker in flight.
+        Batches are finished in the order they were sent (page_id order), so duplicates are found the same way every run.
+        Returns the paths of the runs '''
+        run_paths, pending = [], deque()
         async with session_maker() as session:
-            async for page in get_pages(session, batch_size=self.batch_size):
+            async for chunk in get_pages(session, batch_size=RUN_PAGES):
+                if len(pending) >= self.worker_num:
+                    await self.finish_run(session_maker, pending.popleft())
+
+                path = os.path.join(run_dir, f"{len(run_paths)}.run")
+                run_paths.append(path)
+                self.indexed_pages.extend(page[0] for page in chunk)
+                pending.append(asyncio.ensure_future(self.run_shared(build_run, chunk, self.positions, path)))
+
+        while pending:
+            await self.finish_run(session_maker, pending.popleft())
+        return run_paths
+
+
+    async def run_shared(self, func, chunk, *args):
+        ''' Runs func(shared pages, *args) in the process pool, with the chunk of pages passed through shared memory '''
+        shared = share_pages(chunk)
+        try:
+            return await self.loop.run_in_executor(self.pool, func, shared, *args)
+        finally:
+            shared.close()
+            shared.unlink()
+
+
+    async def finish_run(self, session_maker, future):
+        page_lengths, fingerprints = await future
+        await self.set_page_info(session_maker, page_lengths, fingerprints)
+        self.indexed += len(page_lengths)
+        print(f"{self.indexed} total pages in runs")
+
+
+    async def load_merged(self, session_maker, merged, writer, load_database):
+        ''' Takes the merged postings term by term, adds them to the index file writer and sends their links to the database
+        in chunks of about COPY_ROWS '''
+        records, link_amount = [], 0
+        for record in merged:
+            term, page_ids, frequencies, positions = record
+            if writer:
+                docs, found = writer.find_docs(page_ids)
+                if found.any():
+                    counts = deltas = None
+                    if self.positions:
+                        counts, deltas = pack_positions([deltas for deltas, keep in zip(positions, found) if keep])
+                    writer.add_term(term, docs, np.array(frequencies, dtype=np.uint32)[found], counts, deltas)
+
+            if load_database:
+                records.append(record)
+                link_amount += len(page_ids)
+                if link_amount >= COPY_ROWS:
+                    await self.copy_records(session_maker, records)
+                    records, link_amount = [], 0
+
+        if records:
+            await self.copy_records(session_maker, records)
+
+
+    async def copy_records(self, session_maker, records):
+        ''' COPYs merged (term, page_ids, frequencies, positions) records into term_page_links, with their terms' total_pages
+        (zeroed by clear_term_links) '''
+        term_ids = dict(await self.get_batch_term_ids(session_maker, {record[0]: None for record in records}, None))
+        links, term_deltas = [], {}
+        for term, page_ids, frequencies, positions in records:
+            term_id = term_ids.get(term)
+            if term_id is None:
+                continue
+
+            if self.duplicates:
+                kept = [i for i, page_id in enumerate(page_ids) if page_id not in self.duplicates]
+                page_ids, frequencies = [page_ids[i] for i in kept], [frequencies[i] for i in kept]
+                positions = [positions[i] for i in kept] if positions is not None else None
+
+            term_deltas[term_id] = len(page_ids)
+            if positions is not None:
+                links.extend(zip(repeat(term_id), page_ids, frequencies, positions))
+            else:
+                links.extend(zip(repeat(term_id), page_ids, frequencies))
+
+        if links:
+            await copy_links_safe(session_maker, links, term_deltas)
+
+
+    async def load_term_ids(self, session):
+        ''' Fills the term dictionary with every term already in the database, so batches only send new terms over '''
+        t = time.time()
+        async for batch in get_term_ids(session, batch_size=100000):
+            self.term_ids.update(batch)
+        print(f"Loaded {len(self.term_ids)} term ids in {time.time() - t}")
+
+
+    async def load_fingerprints(self, session):
+        ''' Fills the simhash index with the fingerprints of the pages indexed by earlier runs '''
+        t = time.time()
+        async for batch in get_fingerprints(session, batch_size=100000, version=SIMHASH_VERSION):
+            for page_id, fingerprint in batch:
+                self.simhashes.add(page_id, fingerprint)
+        print(f"Loaded {len(self.simhashes)} fingerprints in {time.time() - t}")
+
+
+    def find_duplicates(self, fingerprints):
+        ''' Checks a chunk's fingerprints against every page indexed so far, returns page_id : canonical page_id for the
+        near duplicates. Pages are checked in page_id order (chunks too, by their callers), so the first page of a group of
+        copies is the one indexed '''
+        if not self.dedupe:
+            return {}
+
+        duplicates = {}
+        for page_id in sorted(fingerprints):
+            canonical = self.simhashes.check(page_id, fingerprints[page_id])
+            if canonical is not None:
+                duplicates[page_id] = canonical
+        self.duplicates.update(duplicates)
+        return duplicates
+
+
+    async def set_page_info(self, session_maker, page_lengths, fingerprints, batch_number=None):
+        ''' Stores a chunk's page lengths and fingerprints, duplicates get no length so they are left out of the index.
+        With a batch_number, waits for the batches before it to be checked for duplicates first. Returns the duplicates '''
+        if batch_number is None:
+            duplicates = self.find_duplicates(fingerprints)
+        else:
+            async with self.dedupe_order:
+                await self.dedupe_order.wait_for(lambda: self.next_batch == batch_number)
+                duplicates = self.find_duplicates(fingerprints)
+                self.next_batch += 1
+                self.dedupe_order.notify_all()
+        if duplicates:
+            page_lengths = {page_id: None if page_id in duplicates else length for page_id, length in page_lengths.items()}
+            print(f"Skipping {len(duplicates)} near duplicate pages")
+
+        await set_page_lengths_safe(session_maker, page_lengths)
+        await set_fingerprints_safe(session_maker, fingerprints, duplicates, SIMHASH_VERSION)
+        return duplicates
+
+
+    async def get_batch_term_ids(self, session_maker, term_batch, worker_id):
+        ''' Returns [term, term_id] for every term in the batch, only inserting the terms the dictionary doesn't know yet '''
+        new_terms = {term: None for term in term_batch if term not in self.term_ids}
+        if new_terms:
+            async with self.semaphore:
+                self.current_insert_user = worker_id
+                for term, term_id in await insert_terms_safe(session_maker, new_terms, MAX_PARAMS):
+                    self.term_ids[term] = term_id
+
+        return [(term, self.term_ids[term]) for term in term_batch if term in self.term_ids]
+
+
+    async def page_getter(self, session_maker, batch_size, after=None, until=None):
+        ''' Feeds (batch number, batch of pages of batch_size length) to the page_chunks queue, only adding new batches to
+        the queue when term_insert_workers request for an add. Ends with a None for every term_insert_worker.'''
+        async with session_maker() as session:
+            batch_number = 0
+            async for page in get_pages(session, batch_size=batch_size, incremental=self.incremental, after=after, until=until):
                 async with self.condition:
                     await self.condition.wait_for(lambda: self.batch_requests > 0)
                     print("Added new batch")
                     self.batch_requests -= 1
-                    await self.page_chunks.put(page)
+                    await self.page_chunks.put((batch_number, page))
+                batch_number += 1
                     
             self.adding_new_pages = False
+            for _ in range(self.term_worker_num): # wakes up the workers waiting for a batch so they can exit
+                await self.page_chunks.put(None)
 
 
     async def term_insert_worker(self, session_maker, worker_id):
@@ -92,76 +443,61 @@ class index_handler:
         terms to the database, links the terms to the pages that contain them and sends that to the term_link_insert workers '''
 
         try:
-            while self.adding_new_pages or not self.page_chunks.empty():
+            while True:
                 async with self.condition:
                     self.batch_requests += 1
                     self.condition.notify()
 
-                chunk = await self.page_chunks.get()
+                batch = await self.page_chunks.get()
                 self.page_chunks.task_done()
+                if batch is None: # no pages left
+                    break
 
+                batch_number, chunk = batch
                 t = time.time()
-                term_data = await self.loop.run_in_executor(self.pool, process_chunk, chunk, self.stopwords)
+                result = await self.run_shared(index_shared_chunk, chunk, self.positions)
+                duplicates = await self.set_page_info(session_maker, result.page_lengths, result.fingerprints, batch_number)
 
-                for term_batch in batch_dict(term_data, self.batch_size):
-                    async with self.semaphore:
-                        self.current_insert_user = worker_id
-                        term_ids = await insert_terms_safe(session_maker, term_batch, MAX_PARAMS) #list containing [term, term_id] for all inserted terms 
-                    
-                    term_values = []
-                    for term, term_id in term_ids:
-                        length = min(MAX_PARAMS, len(term_values))
-                        if length >= MAX_PARAMS:
-                            chunk_values, term_values = term_values[:length], term_values[length:]
-                            chunk_values = sorted(chunk_values, key=lambda x: x["term_id"]) #sort to avoid sharelocks
-                            await self.insert_chunks.put(chunk_values)
-
-                        pages_containing_term = term_batch[term]
-                        row = [{"term_id": term_id, "page_id": page_id} for page_id in pages_containing_term]
-                        term_values.extend(row)
-
-                    if term_values:
-                        term_values = sorted(term_values, key=lambda x : x['term_id']) #sort to avoid sharelocks
-                        await self.insert_chunks.put(term_values)
+                page_ids = [page[0] for page in chunk]
 
-                self.indexed += self.batch_size
-                print(f"Finished a batch of {self.batch_size} pages. {self.indexed} total pages done")
+                keep = np.ones(len(result.page_ids), dtype=bool)
+                if duplicates:
+                    keep = ~np.isin(result.page_ids, list(duplicates))
+                pages_containing_terms = np.bincount(result.term_numbers[keep], minlength=len(result.terms))
+
+                needed_terms = [term for term, pages in zip(result.terms, pages_containing_terms) if pages]
+                term_ids = dict(await self.get_batch_term_ids(session_maker, needed_terms, worker_id))
+                term_ids = np.array([term_ids.get(term, -1) for term in result.terms], dtype=np.int64) # -1 if not needed or inserting it failed
+                term_deltas = {term_id: pages_containing_term for term_id, pages_containing_term
+                               in zip(term_ids.tolist(), pages_containing_terms.tolist()) if term_id >= 0}
+
+                link_term_ids = term_ids[result.term_numbers]
+                keep &= link_term_ids >= 0
+                columns = [link_term_ids[keep].tolist(), result.page_ids[keep].tolist(), result.frequencies[keep].tolist()]
+                if self.positions:
+                    columns.append([positions for positions, kept in zip(result.link_positions(), keep) if kept])
 
-            if self.page_chunks.empty():
-                self.still_inserting = False # tell db workers that they can exit
+                term_values = list(zip(*columns)) # (term_id, page_id, frequency[, positions]) tuples, copied in by add_chunk
+                # the old links of the pages are removed and the counts changed in the same transaction as the new links go in
+                await self.insert_chunks.put((page_ids, term_values, term_deltas, self.run_start))
+
+                self.indexed += self.batch_size
+                print(f"Finished a batch of {self.batch_size} pages (page_id {chunk[0][0]} to {chunk[-1][0]}). {self.indexed} total pages done")
 
         except asyncio.CancelledError:
             pass
 
-        except Exception as e:
-            print(traceback.format_exc())
-
 
     async def term_link_insert_worker(self, session_maker):
-        ''' Recieves term_id page_id pairs from term_inser worker and writes them to the database. '''
-        chunk = None
+        ''' Recieves the page batches of the term_insert workers (page ids, link tuples, term deltas) and writes each one to the
+        database in one transaction, until it gets a None. '''
         try:
-            while not self.insert_chunks.empty() or self.still_inserting or await self.are_term_workers_alive(): 
-                try:
-                    chunk = await asyncio.wait_for(self.insert_chunks.get(), 10)
-                except asyncio.TimeoutError: # should only time out when the rest of the pipeline is finished working
-                    print('Timed out!')
-                    continue
-                await add_chunk_safe(session_maker, chunk)
+            while (batch := await self.insert_chunks.get()) is not None:
+                await write_page_batch_safe(session_maker, *batch)
         
             print('Finished!')
         except asyncio.CancelledError:
             pass
-        except Exception as e:
-            print(traceback.format_exc())
-
-    
-    async def are_term_workers_alive(self):
-        ''' Checks if term_workers are still running, used by db workers to avoid exiting early'''
-        for task in self.term_workers:
-            if not task.done():
-                return True
-        return False
 
 
 def filter_term(term, amount_of_pages):
@@ -173,83 +509,107 @@ def filter_term(term, amount_of_pages):
     return valid_length_term or frequent_term
 
 
-def process_chunk(chunk, stopwords):
-    ''' Takes a chunk of pages and their content, and converts it to a dictionary of terms and the pages that contain them. Filters out some terms too.'''
-    vowels = "aeiouy"
-    punctuation = {'.': ' ', '?': ' ', '!': ' ', ',': ' ', 
-                    ':': ' ', ';': ' ', '—': ' ', '(': ' ', ')': ' ', 
-                    '[': ' ', ']': ' ', '{': ' ', '}': ' ', '\\': ' ', "'": ' ',
-                    '"': ' ', '/': ' ', '*': ' ', '&': ' ', '~': ' ', '+': ' '}
-    translator = str.maketrans(punctuation)
-    term_finder = re.compile(r"[A-Za-z0-9_\-#@]+")
-
+def process_chunk(chunk, stopwords, positions=False):
+    ''' Takes a chunk of pages and their content, and converts it to a dictionary of terms and the pages that contain them (with how often
+    they contain them), alongside a dictionary of page ids and their length in terms. Filters out some terms too.
+    With positions, also returns a dictionary of term : {page_id : delta encoded positions}, otherwise None in its place.
+    Positions count every kept term, so stopwords don't break up phrases. Last is a dictionary of page_id : simhash.'''
     term_data = {}
+    page_lengths = {}
+    term_positions = {} if positions else None
+    fingerprints = {}
+    term_hashes = {}
 
     for obj in chunk:
         page = page_info(obj[0], obj[1])
-        content = page.content
+        final_terms = index_terms(page.content, stopwords)
 
-        content = content.encode("ascii", "ignore").decode()
-        content = content.translate(translator)
-        terms = term_finder.finditer(content)
+        term_frequencies = Counter(final_terms)
+        for term, frequency in term_frequencies.items():
+            term_data.setdefault(term, {})[page.p_id] = frequency
+        fingerprints[page.p_id] = simhash(term_frequencies, term_hashes)
 
-        final_terms = []
-        terms_seen = set()
-
-        for match in terms:
-            term = match.group().lower()
-   
-            if term in stopwords:
-                continue
-
-            length = len(term)
-            if length <= 1 or length >= 30:
-                continue
-            
-            if length > 20:
-                vowel_amount = sum(char in vowels for char in term)
-                if vowel_amount > 7 and vowel_amount + 1 < length // 2:
-                    continue
-
-            final_terms.append(term)
-            terms_seen.add(term)
-        
-        for term in final_terms:
-            term_data.setdefault(term, []).append(page.p_id)
+        if positions:
+            page_positions = {}
+            for position, term in enumerate(final_terms):
+                page_positions.setdefault(term, []).append(position)
+            for term, term_page_positions in page_positions.items():
+                term_positions.setdefault(term, {})[page.p_id] = delta_encode(term_page_positions)
+        page_lengths[page.p_id] = len(final_terms)
 
     
-    terms = list(term_data.keys())
-    for term in terms:
-        if not filter_term(term, len(term_data[term])): 
-            term_data.pop(term)
+    if not positions: # with positions every term stays, a phrase with a dropped term in it could never match
+        terms = list(term_data.keys())
+        for term in terms:
+            if not filter_term(term, sum(term_data[term].values())): 
+                term_data.pop(term)
         
-    return term_data
+    return term_data, page_lengths, term_positions, fingerprints
 
 
-def batch_dict(full_dict, batch_size):
-    ''' Returns batches of a dictionary as a generator object '''
-    size = 0
-    batch = {}
+def pack_terms(term_data, page_lengths, term_positions=None, fingerprints=None):
+    ''' Flattens process_chunk's results into a chunk_terms '''
+    terms = list(term_data)
+    link_amounts = [len(term_data[term]) for term in terms]
+    total = sum(link_amounts)
+
+    result = chunk_terms(
+        terms=terms,
+        term_numbers=np.repeat(np.arange(len(terms), dtype=np.uint32), link_amounts),
+        page_ids=np.fromiter(chain.from_iterable(term_data[term].keys() for term in terms), dtype=np.int32, count=total),
+        frequencies=np.fromiter(chain.from_iterable(term_data[term].values() for term in terms), dtype=np.uint32, count=total),
+        page_lengths=page_lengths,
+        fingerprints=fingerprints or {})
+
+    if term_positions is not None:
+        link_positions = [term_positions[term][page_id] for term in terms for page_id in term_data[term]]
+        result.position_counts = np.fromiter(map(len, link_positions), dtype=np.uint32, count=total)
+        result.position_deltas = np.fromiter(chain.from_iterable(link_positions), dtype=np.uint32, count=int(result.position_counts.sum()))
+    return result
+
+
+# every worker process gets the stopwords once, when the pool starts it, instead of with every chunk
+worker_stopwords = None
+
+
+def init_worker(stopwords):
+    global worker_stopwords
+    worker_stopwords = stopwords
+
+
+def index_shared_chunk(shared, positions):
+    ''' Runs in a worker process: reads a chunk of pages from shared memory and returns its terms as a chunk_terms '''
+    chunk = read_shared_pages(shared)
+    shared.close()
+    return pack_terms(*process_chunk(chunk, worker_stopwords, positions))
 
-    for key in full_dict.keys():
-        if size >= batch_size:
-            yield batch
-            batch = {}
-            size = 0
-        
-        batch[key] = full_dict[key]
-        size += 1
 
-    if batch:
-        yield batch
+def build_run(shared, positions, path):
+    ''' Runs in a worker process: processes a chunk of pages from shared memory and writes its terms to a sorted run at
+    path, so only the page lengths and fingerprints are sent back '''
+    chunk = read_shared_pages(shared)
+    shared.close()
+    term_data, page_lengths, term_positions, fingerprints = process_chunk(chunk, worker_stopwords, positions)
+    write_run(path, term_data, term_positions)
+    return page_lengths, fingerprints
 
 
 async def main():
     workers = 15 #increase with amount of cores on machine, set to one below amount of cores for best effect
+    positions = False #set to true to allow phrase queries
+    incremental = True #only index pages that are new or changed since the last run (or that an interrupted run didn't get to)
+    offline = False #rebuild everything from sorted runs on disk instead, a lot faster for full rebuilds
+    dedupe = True #skip pages that are near duplicates of pages already indexed
+    sharded = False #split the run with the other indexer nodes started with sharded on
 
     try:
-        indexer = index_handler(workers)
-        await indexer.run_indexer()
+        indexer = index_handler(workers, positions=positions, incremental=incremental and not offline, dedupe=dedupe)
+        if offline:
+            await indexer.run_offline()
+        elif sharded:
+            print(f"Sharded run {await indexer.run_sharded()}")
+        else:
+            await indexer.run_indexer()
     except Exception as e:
         print(traceback.format_exc())
     
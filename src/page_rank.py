@@ -0,0 +1,90 @@
+import asyncio
+import time
+
+import numpy as np
+
+from db import bump_index_generation, connect_to_db, get_page_links, get_page_ranks, set_page_ranks_safe
+
+DAMPING = 0.85
+TOLERANCE = 1e-6 # stop once the ranks change less than this in total (l1) in an iteration
+MAX_ITERATIONS = 100
+
+
+def page_rank(sources, targets, page_amount, start=None, damping=DAMPING, tolerance=TOLERANCE, max_iterations=MAX_ITERATIONS):
+    ''' Power iteration PageRank over a link graph given as arrays of source and target page numbers (0..page_amount).
+    Every iteration is two passes over the links: gather each source's rank share, then bincount them into the targets.
+    start is an optional previous rank vector to warm start from, it is normalized first. Returns ranks summing to 1. '''
+    out_links = np.bincount(sources, minlength=page_amount).astype(np.float64)
+    dangling = out_links == 0 # pages without outlinks spread their rank over every page
+    share = np.divide(1, out_links, out=np.zeros(page_amount), where=~dangling)
+
+    if start is None:
+        ranks = np.full(page_amount, 1 / page_amount)
+    else:
+        ranks = np.asarray(start, dtype=np.float64) / np.sum(start)
+
+    for iteration in range(max_iterations):
+        new_ranks = np.bincount(targets, weights=(ranks * share)[sources], minlength=page_amount)
+        new_ranks = damping * (new_ranks + ranks[dangling].sum() / page_amount) + (1 - damping) / page_amount
+
+        change = np.abs(new_ranks - ranks).sum()
+        ranks = new_ranks
+        if change < tolerance:
+            break
+
+    print(f"PageRank took {iteration + 1} iterations, last change {change}")
+    return ranks
+
+
+async def load_graph(session_maker, batch_size):
+    ''' Loads every page id, their previous page rank and every link between pages. Returns the sorted page ids, the
+    previous relative ranks (nan for new pages) and the links as source and target positions in page ids. '''
+    page_ids, previous = [], []
+    async with session_maker() as session:
+        async for batch in get_page_ranks(session, batch_size):
+            for page_id, rank in batch:
+                page_ids.append(page_id)
+                previous.append(rank)
+
+    page_ids = np.array(page_ids, dtype=np.int64)
+    previous = np.array(previous, dtype=np.float64) # None becomes nan
+
+    sources, targets = [], []
+    async with session_maker() as session:
+        async for batch in get_page_links(session, batch_size):
+            links = np.array(batch, dtype=np.int64).reshape(-1, 2)
+            sources.append(np.searchsorted(page_ids, links[:, 0]))
+            targets.append(np.searchsorted(page_ids, links[:, 1]))
+
+    sources = np.concatenate(sources) if sources else np.zeros(0, dtype=np.int64)
+    targets = np.concatenate(targets) if targets else np.zeros(0, dtype=np.int64)
+    keep = sources != targets # links to itself don't say anything about a page
+    return page_ids, previous, sources[keep], targets[keep]
+
+
+async def run_page_rank(session_maker, warm_start=True, batch_size=100000):
+    ''' Computes PageRank over page_outlinks and stores it as pages.page_rank, relative to the average page so ranks stay
+    comparable as pages get added. Warm starts from the stored ranks, pages without one start out as average. '''
+    t = time.perf_counter()
+    page_ids, previous, sources, targets = await load_graph(session_maker, batch_size)
+    if not len(page_ids):
+        return
+    print(f"Loaded {len(page_ids)} pages and {len(sources)} links in {time.perf_counter() - t}")
+
+    start = None
+    if warm_start and not np.isnan(previous).all():
+        start = np.where(np.isnan(previous), 1.0, previous)
+
+    ranks = page_rank(sources, targets, len(page_ids), start) * len(page_ids)
+    await set_page_ranks_safe(session_maker, page_ids.tolist(), ranks.tolist())
+    await bump_index_generation(session_maker)
+    print(f"Stored page ranks in {time.perf_counter() - t}, export the index again to serve them from the index file")
+
+
+async def main():
+    session_maker = await connect_to_db(2)
+    await run_page_rank(session_maker)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
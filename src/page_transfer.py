@@ -0,0 +1,38 @@
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+# layout of a shared page batch: amount of pages, page ids, offsets of every page's content in the blob, utf-8 content blob
+HEADER_ITEM = np.dtype(np.int64).itemsize
+
+
+def share_pages(chunk):
+    ''' Copies a batch of [page_id, content] pages into a new shared memory block, so worker processes can read it without
+    it being pickled through the pool's pipe. The caller closes and unlinks it once the worker is done with it. '''
+    contents = [page[1].encode() for page in chunk]
+    offsets = np.zeros(len(contents) + 1, dtype=np.int64)
+    np.cumsum([len(content) for content in contents], out=offsets[1:])
+
+    blob_start = HEADER_ITEM * (2 + 2 * len(contents))
+    shared = SharedMemory(create=True, size=max(blob_start + int(offsets[-1]), 1))
+    header = np.ndarray(1 + len(contents) + len(offsets), dtype=np.int64, buffer=shared.buf)
+    header[0] = len(contents)
+    header[1:1 + len(contents)] = [page[0] for page in chunk]
+    header[1 + len(contents):] = offsets + blob_start
+    del header # views into the buffer stop it from being closed
+
+    shared.buf[blob_start:blob_start + int(offsets[-1])] = b"".join(contents)
+    return shared
+
+
+def read_shared_pages(shared):
+    ''' Reads a batch made by share_pages back into [page_id, content] pages '''
+    page_amount = int(np.frombuffer(shared.buf, dtype=np.int64, count=1)[0])
+    header = np.frombuffer(shared.buf, dtype=np.int64, count=1 + 2 * page_amount + 1)
+    page_ids = header[1:1 + page_amount].tolist()
+    offsets = header[1 + page_amount:].tolist()
+    del header
+
+    blob = bytes(shared.buf[offsets[0]:offsets[-1]])
+    start = offsets[0]
+    return [[page_id, blob[begin - start:end - start].decode()] for page_id, begin, end in zip(page_ids, offsets, offsets[1:])]
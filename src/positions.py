@@ -0,0 +1,76 @@
+import numpy as np
+
+PROXIMITY_WINDOW = 8 # query terms further apart than this don't count as near each other
+PROXIMITY_BOOST = 0.5 # score multiplier for a page where every pair of query terms is adjacent
+POSITION_BITS = 32 # positions are packed into the low bits of a key, the doc (or page id) into the high bits
+
+
+def delta_encode(positions):
+    ''' Turns a sorted list of term positions into the first position followed by the gaps between them '''
+    return [positions[0]] + [current - previous for previous, current in zip(positions, positions[1:])]
+
+
+def decode_keys(docs, counts, deltas):
+    ''' Decodes delta encoded positions into one sorted int64 array of (doc << POSITION_BITS) | position keys.
+    docs are sorted, counts are the amount of positions of each doc and deltas are all of their delta lists concatenated '''
+    docs = np.asarray(docs, dtype=np.int64)
+    counts = np.asarray(counts, dtype=np.int64)
+    totals = np.concatenate(([0], np.cumsum(np.asarray(deltas, dtype=np.int64))))
+
+    # the cumsum runs over every doc, so each doc's running total from before it starts is taken back off
+    starts = np.cumsum(counts) - counts
+    positions = totals[1:] - np.repeat(totals[starts], counts)
+
+    return (np.repeat(docs, counts) << POSITION_BITS) | positions
+
+
+def key_docs(keys):
+    return keys >> POSITION_BITS
+
+
+def phrase_docs(term_keys):
+    ''' Docs where the terms appear right after each other, term_keys has the decode_keys of every phrase term in order '''
+    matches = term_keys[0]
+    for offset, keys in enumerate(term_keys[1:], 1):
+        matches = np.intersect1d(matches, keys - offset, assume_unique=True)
+    return np.unique(key_docs(matches))
+
+
+def nearest_distances(keys, other_keys):
+    ''' Distance from every key to the nearest key of the other term in the same doc, keys of other docs are always at least
+    2 ** POSITION_BITS minus a page length away so they never come out as near '''
+    if not len(other_keys):
+        return np.full(len(keys), np.iinfo(np.int64).max)
+
+    after = np.searchsorted(other_keys, keys)
+    distances = np.full(len(keys), np.iinfo(np.int64).max)
+
+    has_after = after < len(other_keys)
+    distances[has_after] = other_keys[after[has_after]] - keys[has_after]
+    has_before = after > 0
+    distances[has_before] = np.minimum(distances[has_before], keys[has_before] - other_keys[after[has_before] - 1])
+    return distances
+
+
+def proximity_boosts(term_keys, docs):
+    ''' Score multipliers for docs based on how close each pair of neighbouring query terms gets in them, 1 if they are
+    never within PROXIMITY_WINDOW of each other and 1 + PROXIMITY_BOOST if every pair appears next to each other '''
+    docs = np.asarray(docs, dtype=np.int64)
+    closeness = np.zeros(len(docs))
+    pairs = list(zip(term_keys, term_keys[1:]))
+    if not pairs or not len(docs):
+        return np.ones(len(docs))
+
+    for keys, next_keys in pairs:
+        distances = nearest_distances(keys, next_keys)
+        near = distances <= PROXIMITY_WINDOW
+        if not near.any():
+            continue
+
+        # the closest the pair gets in each doc, taken from the nearest occurrence
+        pair_closeness = np.zeros(len(docs))
+        found = np.searchsorted(docs, key_docs(keys[near]))
+        np.maximum.at(pair_closeness, found, 1 / distances[near])
+        closeness += pair_closeness
+
+    return 1 + PROXIMITY_BOOST * closeness / len(pairs)
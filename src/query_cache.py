@@ -0,0 +1,89 @@
+import sys
+import time
+from collections import OrderedDict
+
+DEFAULT_CACHE_BYTES = 64 * 1024 * 1024
+
+
+def term_bytes(key):
+    ''' Memory of the term strings in a key, the query terms and the terms of each phrase '''
+    if isinstance(key, str):
+        return sys.getsizeof(key)
+    if isinstance(key, tuple):
+        return sum(term_bytes(part) for part in key)
+    return 0
+
+
+def result_size(key, results):
+    ''' Rough amount of memory a cached query uses, results are in the scoring.score_pages format '''
+    size = term_bytes(key) + sys.getsizeof(results)
+    for url, score, details in results:
+        size += sys.getsizeof(url) + sys.getsizeof(score) + sys.getsizeof(details) + len(details) * sys.getsizeof(0.0)
+    return size
+
+
+class query_cache:
+    ''' LRU cache of query results, keyed by the tuple of query terms. Entries are evicted least recently used first once
+    max_bytes is used up, expire after ttl seconds if ttl is set, and are all dropped when the index generation changes. '''
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES, ttl=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict() # key : (results, size, time added)
+        self.used_bytes = 0
+        self.generation = None
+
+        self.hits = 0
+        self.misses = 0
+
+
+    def check_generation(self, generation):
+        ''' Drops everything if the index has changed since the cached results were made '''
+        if generation != self.generation:
+            self.clear()
+            self.generation = generation
+
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        results, size, added = entry
+        if self.ttl is not None and time.monotonic() - added > self.ttl:
+            self.remove(key)
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return results
+
+
+    def put(self, key, results):
+        if key in self.entries:
+            self.remove(key)
+
+        size = result_size(key, results)
+        if size > self.max_bytes:
+            return
+
+        self.entries[key] = (results, size, time.monotonic())
+        self.used_bytes += size
+        while self.used_bytes > self.max_bytes:
+            self.remove(next(iter(self.entries)))
+
+
+    def remove(self, key):
+        _, size, _ = self.entries.pop(key)
+        self.used_bytes -= size
+
+
+    def clear(self):
+        self.entries.clear()
+        self.used_bytes = 0
+
+
+    def __len__(self):
+        return len(self.entries)
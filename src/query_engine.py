@@ -1,24 +1,22 @@
+import os
 import re
 import time
-from collections import Counter
 from math import log10
 
 import numpy as np
 import asyncio
+from dotenv import load_dotenv
 
-from db import connect_to_db, count_pages, get_total_pages_for_terms, retrieve_term_pages
+from disk_index import DEFAULT_INDEX_PATH, disk_index
+from db import (connect_to_db, count_pages, get_index_generation, get_index_stats, get_total_pages_for_terms, retrieve_positions,
+                retrieve_postings)
+from scoring import ADDITIVE_RANKERS, BM25_B, BM25_K1, bm25_idf, bm25_params, build_candidates, score_pages, select_pages
+from positions import decode_keys, key_docs, phrase_docs, proximity_boosts
+from block_max import block_max_search
+from query_cache import DEFAULT_CACHE_BYTES, query_cache
+from terms import index_terms, split_terms
 
-
-def to_terms(doc, translator, term_finder):
-    doc = doc.translate(translator)
-    doc = doc.lower()
-    return term_finder.findall(doc)
-
-
-def get_vector_tf(query_terms, doc_terms):
-    length = len(doc_terms)
-    count = Counter(doc_terms)
-    return {term : count[term] / length for term in query_terms}
+PHRASE_FINDER = re.compile(r'"([^"]*)"')
 
 
 async def get_vector_idf(terms, term_total_pages, total_pages):
@@ -34,93 +32,283 @@ async def get_vector_idf(terms, term_total_pages, total_pages):
     return idf_vector
     
 
-def get_tf_idf(query_terms, doc_terms, vectorized_idf):
-    tf_idf = {}
+async def get_pages_from_db(session_maker, terms):
+    ''' Gets every page containing one of the query terms from the database '''
+    async with session_maker() as session:
+        rows = await retrieve_postings(session, terms)
 
-    vectorized_tf = get_vector_tf(query_terms, doc_terms)
-    for term in vectorized_tf.keys():
-        tf_idf[term] = vectorized_tf[term] * vectorized_idf[term]
-    return tf_idf
+    term_rows = {term: [] for term in terms}
+    page_lengths = {}
+    page_urls = {}
+    page_ranks = {}
+    for term, page_id, page_url, page_length, page_rank, frequency in rows:
+        term_rows[term].append((page_id, frequency))
+        page_urls[page_id] = page_url
+        page_lengths[page_id] = page_length or 0 # not indexed with page lengths yet
+        page_ranks[page_id] = page_rank if page_rank is not None else np.nan
 
+    term_postings = []
+    for term in terms:
+        postings = np.array(term_rows[term], dtype=np.int64).reshape(-1, 2)
+        term_postings.append((postings[:, 0], postings[:, 1].astype(np.float64)))
 
-def dict_dot_prod(dict_one, dict_two):
-    return sum(dict_one[k] * dict_two[k] for k in dict_one)
+    get_lengths = lambda keys: [page_lengths[key] for key in keys.tolist()]
+    get_ranks = lambda keys: [page_ranks[key] for key in keys.tolist()]
+    return build_candidates(term_postings, get_lengths, page_urls.__getitem__, get_ranks)
 
 
-def get_cosine_simmilarity(vec_one, vec_two):
-    dot_prod = dict_dot_prod(vec_one, vec_two)
-    vec_one_len = np.sqrt(sum(item * item for item in vec_one.values()))
-    vec_two_len =  np.sqrt(sum(item * item for item in vec_two.values()))
+def get_pages_from_index(index, term_numbers):
+    ''' Same as get_pages_from_db, but read from a memory mapped disk_index without any database round trips '''
+    term_postings = []
+    for term_number in term_numbers:
+        if term_number is None:
+            term_postings.append((np.zeros(0, dtype=np.uint32), np.zeros(0, dtype=np.uint32)))
+        else:
+            term_postings.append(index.postings(term_number))
 
-    if vec_one_len == 0 or vec_two_len == 0:
-        return 0
-    return dot_prod / (vec_one_len * vec_two_len)
+    return build_candidates(term_postings, lambda keys: index.doc_lengths[keys], index.url, lambda keys: index.doc_ranks[keys])
 
 
-def link_rank(url, query_terms):
-    score = 0
-    for term in query_terms:
-        if term in url.lower():
-            score += 0.15
-    return score
+async def get_position_keys_from_db(session_maker, terms, page_ids):
+    ''' positions.decode_keys keys of every term in the given pages, keyed by term '''
+    async with session_maker() as session:
+        rows = await retrieve_positions(session, terms, page_ids)
 
+    term_rows = {term: ([], [], []) for term in terms}
+    for term, page_id, positions in rows:
+        docs, counts, deltas = term_rows[term]
+        docs.append(page_id)
+        counts.append(len(positions) if positions else 0) # stored without positions
+        deltas.extend(positions or [])
 
-async def main():
-    punctuation = {'.': ' ', '?': ' ', '!': ' ', ',': ' ', 
-                    ':': ' ', ';': ' ', '—': ' ', '(': ' ', ')': ' ', 
-                    '[': ' ', ']': ' ', '{': ' ', '}': ' ', '\\': ' ', "'": ' ',
-                    '"': ' ', '/': ' ', '*': ' ', '&': ' ', '~': ' ', '+': ' '}
-    translator = str.maketrans(punctuation)
-    term_finder = re.compile(r"[A-Za-z0-9_\-#@]+")
-    
-    session_maker = await connect_to_db(15)
+    return {term: decode_keys(*term_rows[term]) for term in terms}
 
-    async with session_maker() as session:
-        total_pages = float(await count_pages(session))
-    
-    query = None
-    while query != "(quit)":
-        query = input("New input!: ")
 
-        t = time.perf_counter()
+def get_position_keys_from_index(index, term_numbers, terms, docs):
+    ''' Same as get_position_keys_from_db, but read from a disk_index '''
+    keys = {}
+    for term, term_number in zip(terms, term_numbers):
+        keys[term] = index.position_keys(term_number, docs) if term_number is not None else np.zeros(0, dtype=np.int64)
+    return keys
+
+
+def filter_phrases(pages, phrases, term_keys):
+    ''' Keeps only the pages containing every phrase '''
+    for phrase in phrases:
+        pages = select_pages(pages, np.isin(pages.keys, phrase_docs([term_keys[term] for term in phrase])))
+    return pages
+
+
+class search_engine:
+    ''' Everything needed to answer queries, kept warm between them: the disk_index or database pool, the collection stats
+    and the result cache. ranker is one of scoring.RANKERS. prune turns on block-max top k retrieval when serving from an
+    index file, it's off by default and only works with the additive rankers (tfidf and bm25), a cosine score isn't a sum
+    of per term scores so it has no block upper bounds. k1 and b tune bm25, proximity boosts pages where the query terms
+    appear close together.
+    Quoted phrases in a query only match pages containing the exact phrase, both need an index made with positions.
+    The index generation is checked at most every refresh_interval seconds. '''
+
+    def __init__(self, ranker="cosine", prune=False, k1=BM25_K1, b=BM25_B, pool_size=15, refresh_interval=0, proximity=False):
+        if prune and ranker not in ADDITIVE_RANKERS:
+            raise ValueError(f"Pruning needs one of {ADDITIVE_RANKERS}, not {ranker}")
+
+        self.ranker = ranker
+        self.prune = prune
+        self.proximity = proximity
+        self.k1 = k1
+        self.b = b
+        self.pool_size = pool_size
+        self.refresh_interval = refresh_interval
+
+        with open("stopwords.txt", "r") as f:
+            self.stopwords = set([word.strip() for word in f.readlines()])
+
+        load_dotenv()
+        self.index_path = os.getenv("INDEX_PATH", DEFAULT_INDEX_PATH)
+        ttl = os.getenv("QUERY_CACHE_TTL")
+        self.cache = query_cache(int(os.getenv("QUERY_CACHE_BYTES", DEFAULT_CACHE_BYTES)), float(ttl) if ttl else None)
+
+        self.index = None
+        self.session_maker = None
+        self.generation = None
+        self.last_refresh = None
+        self.refresh_lock = asyncio.Lock()
+
+        self.total_pages = 0.0
+        self.bm25 = None
+        self.term_pages = {} # term : amount of pages with it, for the current generation
+
+
+    async def current_generation(self):
+        # the indexer publishes a new generation by replacing the index file or bumping it in the index_stats table
+        if os.path.exists(self.index_path):
+            info = os.stat(self.index_path)
+            return (info.st_ino, info.st_mtime_ns)
+
+        if not self.session_maker:
+            self.session_maker = await connect_to_db(self.pool_size)
+        async with self.session_maker() as session:
+            return await get_index_generation(session)
+
+
+    async def refresh(self):
+        ''' Reloads the index or stats and drops cached results if the indexer has published a new generation '''
+        if self.last_refresh is not None and time.monotonic() - self.last_refresh < self.refresh_interval:
+            return
 
-        q_terms = to_terms(query, translator, term_finder)
+        async with self.refresh_lock:
+            if self.last_refresh is not None and time.monotonic() - self.last_refresh < self.refresh_interval:
+                return
 
-        async with session_maker() as session:
-            term_total_pages = await get_total_pages_for_terms(session, q_terms)
+            generation = await self.current_generation()
+            self.last_refresh = time.monotonic()
+            if generation == self.generation:
+                return
 
-        q_idf = await get_vector_idf(q_terms, term_total_pages, total_pages)
-        query_tf_idf = get_tf_idf(q_terms, q_terms, q_idf)
-        print(query_tf_idf)
+            # queries still running keep their own reference to the old index, it is unmapped once they finish
+            if os.path.exists(self.index_path):
+                self.index = disk_index(self.index_path)
+                self.total_pages = float(self.index.total_pages)
+                average_length = self.index.average_length
+                print(f"Serving queries from {self.index_path}")
+            else:
+                self.index = None
+                async with self.session_maker() as session:
+                    stats = await get_index_stats(session)
+                    if stats:
+                        total_pages, average_length = stats
+                    else: # indexed before stats were stored
+                        total_pages, average_length = await count_pages(session), None
+                self.total_pages = float(total_pages)
 
-        all_pages = []
-        async with session_maker() as session:
-            for term in q_terms:
-                all_pages.extend(await retrieve_term_pages(session, term))
-       
-        all_pages = set(all_pages)
-        scores = []
-        for item in all_pages:
-            page_url, page_content = item
-            terms = to_terms(page_content, translator, term_finder)
+            self.bm25 = None
+            if self.ranker == "bm25":
+                if not average_length:
+                    raise ValueError("bm25 needs the index stats stored by the indexer, rerun the indexer first")
+                self.bm25 = bm25_params(average_length, self.k1, self.b)
 
-            tf_idf = get_tf_idf(q_terms, terms, q_idf)
-            simmilarity = get_cosine_simmilarity(query_tf_idf, tf_idf)
-            l_rank = 1 + link_rank(page_url, q_terms)
+            self.term_pages = {}
+            self.cache.check_generation(generation)
+            self.generation = generation
 
-            score = (simmilarity ** 1.2) * (l_rank) 
 
-            scores.append([page_url, score, [simmilarity, l_rank, tf_idf]])
+    async def get_term_pages(self, index, terms):
+        ''' Amount of pages containing each term, terms the index doesn't have are left out '''
+        if index:
+            term_numbers = [index.find_term(term) for term in terms]
+            return term_numbers, {term: int(index.term_df[number]) for term, number in zip(terms, term_numbers) if number is not None}
+
+        missing = [term for term in terms if term not in self.term_pages]
+        if missing:
+            async with self.session_maker() as session:
+                for term, pages in await get_total_pages_for_terms(session, missing):
+                    self.term_pages[term] = pages
+        return None, {term: self.term_pages[term] for term in terms if term in self.term_pages}
+
+
+    def phrase_terms(self, phrase):
+        ''' A phrase's terms as the indexer counted their positions, the terms it leaves out aren't in the index '''
+        return index_terms(phrase, self.stopwords)
+
+
+    async def positional_search(self, index, term_numbers, q_terms, terms, idf, bm25, phrases):
+        ''' Exhaustive search that only keeps pages with every phrase in them and, with proximity on, boosts pages where
+        the query terms are close together '''
+        if index:
+            pages = await asyncio.to_thread(get_pages_from_index, index, term_numbers)
+        else:
+            pages = await get_pages_from_db(self.session_maker, terms)
+
+        # a page can only have the phrase if it has all of its terms
+        for phrase in phrases:
+            pages = select_pages(pages, (pages.frequencies[:, [terms.index(term) for term in phrase]] > 0).all(axis=1))
+        if not len(pages.keys):
+            return []
+
+        position_terms = terms if self.proximity else list(dict.fromkeys(term for phrase in phrases for term in phrase))
+        if index and not index.has_positions:
+            term_keys = None
+        elif index:
+            numbers = [term_numbers[terms.index(term)] for term in position_terms]
+            term_keys = await asyncio.to_thread(get_position_keys_from_index, index, numbers, position_terms, pages.keys)
+        else:
+            term_keys = await get_position_keys_from_db(self.session_maker, position_terms, pages.keys.tolist())
+
+        if term_keys is None:
+            print("The index has no positions, phrases only need all of their terms")
+            return await asyncio.to_thread(score_pages, pages, q_terms, terms, idf, ranker=self.ranker, bm25=bm25)
+
+        # terms in some of the pages that came back without positions, stored by an indexer run without them
+        missing = [term for term in position_terms if not len(term_keys[term]) and pages.frequencies[:, terms.index(term)].any()]
+        if missing:
+            print(f"No positions stored for {', '.join(missing)}, phrases only need all of their terms")
+            return await asyncio.to_thread(score_pages, pages, q_terms, terms, idf, ranker=self.ranker, bm25=bm25)
+
+        pages = filter_phrases(pages, phrases, term_keys)
+        boosts = None
+        if self.proximity:
+            in_pages = [keys[np.isin(key_docs(keys), pages.keys)] for keys in (term_keys[term] for term in terms)]
+            boosts = proximity_boosts(in_pages, pages.keys)
+        return await asyncio.to_thread(score_pages, pages, q_terms, terms, idf, ranker=self.ranker, bm25=bm25, boosts=boosts)
+
+
+    async def search(self, query):
+        ''' Returns (results, cached) for a query, results in the scoring.score_pages format. Scoring runs in a thread so
+        the event loop keeps serving other queries meanwhile. '''
+        await self.refresh()
+        index, total_pages, bm25 = self.index, self.total_pages, self.bm25 # a refresh can swap these mid query
+
+        q_terms = split_terms(query)
+        phrases = [phrase for phrase in map(self.phrase_terms, PHRASE_FINDER.findall(query)) if len(phrase) > 1]
+        key = (tuple(q_terms), tuple(map(tuple, phrases)))
+        results = self.cache.get(key)
+        if results is not None:
+            return results, True
+
+        generation = self.generation
+        terms = list(dict.fromkeys(q_terms)) # unique, in query order
+        term_numbers, term_pages = await self.get_term_pages(index, terms)
+
+        if self.ranker == "bm25":
+            idf = bm25_idf([term_pages.get(term, 0) for term in terms], total_pages)
+        else:
+            q_idf = await get_vector_idf(q_terms, term_pages.items(), total_pages)
+            idf = np.array([q_idf[term] for term in terms], dtype=np.float64)
+
+        if phrases or (self.proximity and len(terms) > 1):
+            results = await self.positional_search(index, term_numbers, q_terms, terms, idf, bm25, phrases)
+        elif index and self.prune and self.ranker in ADDITIVE_RANKERS:
+            results = await asyncio.to_thread(block_max_search, index, term_numbers, q_terms, terms, idf, self.ranker, bm25=bm25)
+        elif index:
+            pages = await asyncio.to_thread(get_pages_from_index, index, term_numbers)
+            results = await asyncio.to_thread(score_pages, pages, q_terms, terms, idf, ranker=self.ranker, bm25=bm25)
+        else:
+            pages = await get_pages_from_db(self.session_maker, terms)
+            results = await asyncio.to_thread(score_pages, pages, q_terms, terms, idf, ranker=self.ranker, bm25=bm25)
+
+        if generation == self.generation: # don't cache results of an index that was replaced meanwhile
+            self.cache.put(key, results)
+        return results, False
+
+
+async def main(ranker="cosine", prune=False, k1=BM25_K1, b=BM25_B):
+    ''' Runs the query loop, see search_engine for the arguments '''
+    engine = search_engine(ranker, prune, k1, b)
+
+    query = None
+    while query != "(quit)":
+        query = input("New input!: ")
+
+        t = time.perf_counter()
+        scores, _ = await engine.search(query)
 
-        scores = sorted(scores, key=lambda x: x[1], reverse=True)
-        for score in scores[:20]:
+        for score in scores:
             print(score[0])
             pass
-            #print(score[0], score[1], score[2], score[2][1])
+            #print(score[0], score[1], score[2])
         
         print(time.perf_counter() - t)
 
 
 if __name__ == "__main__":
     asyncio.run(main())
-    
\ No newline at end of file
@@ -0,0 +1,75 @@
+import os
+import time
+
+import asyncio
+from aiohttp import web
+from dotenv import load_dotenv
+
+from query_engine import search_engine
+from scoring import BM25_B, BM25_K1, RANKERS
+
+DEFAULT_PORT = 8080
+MAX_QUERY_LENGTH = 1000
+REFRESH_INTERVAL = 1.0 # seconds between index generation checks
+
+
+async def handle_search(request):
+    ''' GET /search?q=query, returns the ranked pages as json '''
+    t = time.perf_counter()
+    query = request.query.get("q", "")
+    if not query.strip():
+        raise web.HTTPBadRequest(text="missing query parameter q")
+    if len(query) > MAX_QUERY_LENGTH:
+        raise web.HTTPBadRequest(text=f"query is longer than {MAX_QUERY_LENGTH} characters")
+
+    results, cached = await request.app["engine"].search(query)
+    elapsed = (time.perf_counter() - t) * 1000
+    print(f"{request.remote} {query!r}: {len(results)} results in {elapsed:.1f}ms{' (cached)' if cached else ''}")
+
+    return web.json_response({
+        "query": query,
+        "results": [{"url": url, "score": score, "base_score": details[0], "link_rank": details[1], "page_rank": details[2]} for url, score, details in results],
+        "cached": cached,
+        "time_ms": elapsed,
+    }, headers={"Server-Timing": f"search;dur={elapsed:.3f}"})
+
+
+async def handle_health(request):
+    engine = request.app["engine"]
+    return web.json_response({"ranker": engine.ranker, "total_pages": engine.total_pages, "cached_queries": len(engine.cache),
+                              "cache_hits": engine.cache.hits, "cache_misses": engine.cache.misses})
+
+
+def make_app(engine):
+    app = web.Application()
+    app["engine"] = engine
+    app.router.add_get("/search", handle_search)
+    app.router.add_get("/health", handle_health)
+    return app
+
+
+async def main():
+    load_dotenv()
+    ranker = os.getenv("RANKER", "cosine")
+    if ranker not in RANKERS:
+        raise ValueError(f"Unknown ranker {ranker}, expected one of {RANKERS}")
+
+    prune = os.getenv("PRUNE", "0") == "1" # block-max pruning, needs RANKER=tfidf or bm25
+    engine = search_engine(ranker, prune, k1=float(os.getenv("BM25_K1", BM25_K1)), b=float(os.getenv("BM25_B", BM25_B)),
+                           refresh_interval=REFRESH_INTERVAL)
+    await engine.refresh() # load the index and connect before taking requests
+
+    runner = web.AppRunner(make_app(engine))
+    await runner.setup()
+    site = web.TCPSite(runner, os.getenv("QUERY_HOST", "0.0.0.0"), int(os.getenv("QUERY_PORT", DEFAULT_PORT)))
+    await site.start()
+    print(f"Serving queries on {site.name}")
+
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,11 +1,14 @@
 from collections import deque
 import itertools
+import sqlite3
 from functools import cache
 
 import janus
 import asyncio
 import tldextract
 
+from url_filter import load_seen_filter
+
 
 @cache
 def to_top_domain(link: str): #i dont care about DRY **** you!!! i know this is repeated in util.py!
@@ -59,42 +62,52 @@ class jqueue:
         return item in self.queue
 
 
-class sized_set:
-    def __init__(self, max_size):
-        self.max_size = max_size
-        self.set = set()
-        self.queue = deque()
-    
-    
-    def add(self, item):
-        if item in self.set: return
-        self.set.add(item)
-        self.queue.append(item)
+class frontier_store:
+    ''' SQLite file holding the links that don't fit in memory, oldest first. A link is only stored once. '''
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL") # a crash can lose the last few writes, not corrupt the file
+        self.db.execute("CREATE TABLE IF NOT EXISTS frontier (id INTEGER PRIMARY KEY, url TEXT UNIQUE NOT NULL)")
+        self.db.commit()
+        self.size = self.db.execute("SELECT count(*) FROM frontier").fetchone()[0]
 
-        if len(self.queue) > self.max_size:
-            item = self.queue.popleft()
-            self.set.remove(item)
 
+    def __len__(self):
+        return self.size
 
-    def remove(self, item):
-        self.queue.remove(item)
-        self.set.remove(item)
-    
 
-    def __repr__(self):
-        return self.set.__repr__()
+    def add(self, urls) -> None:
+        before = self.db.total_changes
+        self.db.executemany("INSERT OR IGNORE INTO frontier (url) VALUES (?)", ((url,) for url in urls))
+        self.db.commit()
+        self.size += self.db.total_changes - before
 
-    
-    def __contains__(self, item):
-        return item in self.set
+
+    def take(self, amount: int) -> list:
+        ''' Removes and returns up to amount of the oldest links '''
+        rows = self.db.execute("SELECT id, url FROM frontier ORDER BY id LIMIT ?", (amount,)).fetchall()
+        if rows:
+            self.db.execute("DELETE FROM frontier WHERE id <= ?", (rows[-1][0],))
+            self.db.commit()
+            self.size -= len(rows)
+        return [url for _, url in rows]
+
+
+    def close(self) -> None:
+        self.db.close()
 
 
 #TODO move into webcrawler
 class unique_queue:
-    def __init__(self):
+    def __init__(self, frontier_path="frontier.db", seen_path="seen_urls.bloom", memory_batches=5000):
         self.queue = asyncio.Queue(maxsize=5000)
-        self.shuffle_queue = deque(maxlen=5000)
-        self.seen_pages = sized_set(25000)
+        self.shuffle_queue = deque() # hot window of link batches, anything past memory_batches spills to the frontier store
+        self.seen_path = seen_path
+        self.seen_pages = load_seen_filter(seen_path) # every url that was crawled, kept between runs
+
+        self.memory_batches = memory_batches
+        self.store = frontier_store(frontier_path) # links left over from earlier runs are picked up by the next shuffle
     
 
     def put(self, item) -> None: # assume item is iterable
@@ -105,6 +118,38 @@ class unique_queue:
 
         if dedupe:
             self.shuffle_queue.append(tuple(dedupe))
+            if len(self.shuffle_queue) > self.memory_batches:
+                self.spill()
+
+
+    def spill(self) -> None:
+        ''' Moves the newest batches past memory_batches to disk '''
+        spilled = []
+        while len(self.shuffle_queue) > self.memory_batches // 2:
+            spilled.extend(self.shuffle_queue.pop())
+        self.store.add(reversed(spilled)) # oldest first
+
+
+    def refill(self, batch_size: int = 50) -> None:
+        ''' Loads links back from disk once the hot window runs low '''
+        free = self.memory_batches // 2 - len(self.shuffle_queue)
+        if free <= 0 or not len(self.store):
+            return
+
+        urls = self.store.take(free * batch_size)
+        self.shuffle_queue.extend(tuple(urls[i:i + batch_size]) for i in range(0, len(urls), batch_size))
+
+
+    def save(self, extra_urls=()) -> None:
+        ''' Writes every link still waiting in memory (and extra_urls, links handed out but not crawled) to disk, so the
+        next run continues from them '''
+        urls = list(extra_urls)
+        for batch in itertools.chain(self.queue._queue, self.shuffle_queue):
+            urls.extend(batch)
+        self.store.add(urls)
+        self.store.close()
+        self.seen_pages.save(self.seen_path)
+        print(f"Saved {len(self.store)} links to the frontier and {len(self.seen_pages)} crawled links")
     
 
     async def get(self) -> None:
@@ -127,6 +172,7 @@ class unique_queue:
     async def shuffle(self, domain_distance: int, batch_size: int = 10) -> None:
         self.shuffle_queue.extend(self.queue._queue)
         self.queue._queue = deque()
+        self.refill()
 
         size = min(len(self.shuffle_queue), 15000)
         temp_queue = deque(itertools.islice(self.shuffle_queue, 0, size))
@@ -154,7 +200,7 @@ class unique_queue:
         while len(remaining_domains) > exit_amount:
             temp = []
 
-            for domain in remaining_domains:
+            for i, domain in enumerate(remaining_domains):
                 queue = domain_pages[domain]
 
                 if queue:
@@ -169,9 +215,14 @@ class unique_queue:
 
                 if added >= domain_distance: 
                     added = 0
+                    temp.extend(remaining_domains[i + 1:]) # the domains this round didn't get to
                     break
 
             remaining_domains = temp     
+        for domain in remaining_domains: # not spread out this time, keep them for the next shuffle
+            leftover.appendleft(tuple(domain_pages[domain]))
         self.shuffle_queue = leftover
+        if len(self.shuffle_queue) > self.memory_batches:
+            self.spill()
         if batch:
             await self.queue.put(batch)
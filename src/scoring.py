@@ -0,0 +1,192 @@
+from dataclasses import dataclass
+from typing import Callable
+
+import numpy as np
+
+TOP_K = 20
+LINK_RANK_BOOST = 0.15
+PAGE_RANK_BOOST = 0.5 # score multiplier for the highest ranked pages
+PAGE_RANK_CAP = 1000.0 # relative page rank at which the boost stops growing
+
+RANKERS = ("cosine", "tfidf", "bm25")
+ADDITIVE_RANKERS = ("tfidf", "bm25") # scores are a sum of per term scores, so they can be pruned with block-max bounds
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+
+@dataclass
+class candidate_pages:
+    ''' Struct containing every page that has at least one query term. frequencies has a row per page and a column per
+    unique query term, keys are doc numbers in a disk_index or page ids in the database, ranks are relative page ranks '''
+    keys: np.ndarray
+    lengths: np.ndarray
+    frequencies: np.ndarray
+    get_url: Callable
+    ranks: np.ndarray
+
+
+@dataclass
+class bm25_params:
+    ''' Struct containing the collection stats and tunable parameters of bm25 '''
+    average_length: float
+    k1: float = BM25_K1
+    b: float = BM25_B
+
+
+def build_candidates(term_postings, get_lengths, get_url, get_ranks):
+    ''' Merges a (keys, frequencies) pair of arrays per unique query term into a single candidate_pages '''
+    if not term_postings:
+        return candidate_pages(np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros((0, 0)), get_url, np.zeros(0))
+
+    keys, inverse = np.unique(np.concatenate([term_keys for term_keys, _ in term_postings]), return_inverse=True)
+    frequencies = np.zeros((len(keys), len(term_postings)))
+
+    start = 0
+    for column, (term_keys, term_frequencies) in enumerate(term_postings):
+        end = start + len(term_keys)
+        frequencies[inverse[start:end], column] = term_frequencies
+        start = end
+
+    return candidate_pages(keys, np.asarray(get_lengths(keys), dtype=np.float64), frequencies, get_url,
+                           np.asarray(get_ranks(keys), dtype=np.float64))
+
+
+def select_pages(pages, mask):
+    ''' The candidate_pages for which mask is true '''
+    return candidate_pages(pages.keys[mask], pages.lengths[mask], pages.frequencies[mask], pages.get_url, pages.ranks[mask])
+
+
+def link_rank(url, query_terms):
+    score = 0
+    for term in query_terms:
+        if term in url.lower():
+            score += LINK_RANK_BOOST
+    return score
+
+
+def link_ranks(urls, query_terms):
+    ''' link_rank for a list of urls at once '''
+    lowered = np.char.lower(np.array(urls, dtype=str))
+    scores = np.zeros(len(urls))
+    for term in query_terms:
+        scores += LINK_RANK_BOOST * (np.char.find(lowered, term) >= 0)
+    return scores
+
+
+def page_rank_boosts(ranks):
+    ''' Score multipliers from relative page ranks, growing with the log of the rank up to 1 + PAGE_RANK_BOOST at
+    PAGE_RANK_CAP. Pages without a page rank (nan) count as average '''
+    ranks = np.nan_to_num(np.asarray(ranks, dtype=np.float64), nan=1.0)
+    return 1 + PAGE_RANK_BOOST * np.minimum(np.log1p(ranks) / np.log1p(PAGE_RANK_CAP), 1)
+
+
+def top_k(scores, k):
+    ''' Indices of the k highest scores, highest first, without sorting the whole array '''
+    if len(scores) > k:
+        best = np.argpartition(scores, -k)[-k:]
+    else:
+        best = np.arange(len(scores))
+    return best[np.argsort(-scores[best], kind="stable")]
+
+
+def query_weights(query_terms, terms, idf):
+    ''' tf-idf vector of the query over its unique terms '''
+    query_counts = np.array([query_terms.count(term) for term in terms], dtype=np.float64)
+    return query_counts / len(query_terms) * idf
+
+
+def bm25_idf(term_pages, total_pages):
+    ''' bm25's idf for an array of term document frequencies '''
+    term_pages = np.asarray(term_pages, dtype=np.float64)
+    return np.log(1 + (total_pages - term_pages + 0.5) / (term_pages + 0.5))
+
+
+def bm25_tf(frequencies, lengths, bm25):
+    ''' bm25's saturated term frequency, lengths broadcast against frequencies '''
+    length_norm = bm25.k1 * (1 - bm25.b + bm25.b * lengths / bm25.average_length)
+    return frequencies * (bm25.k1 + 1) / (frequencies + length_norm)
+
+
+def term_weights(ranker, query_terms, terms, idf):
+    ''' Per term weights of an additive ranker, a page's base score is the sum of weight * term_scores over its terms '''
+    if ranker == "tfidf":
+        return query_weights(query_terms, terms, idf) * idf
+    if ranker == "bm25":
+        return np.array([query_terms.count(term) for term in terms], dtype=np.float64) * idf
+    raise ValueError(f"{ranker} is not an additive ranker")
+
+
+def term_scores(ranker, frequencies, lengths, bm25=None):
+    ''' Unweighted per term scores of an additive ranker, lengths broadcast against frequencies '''
+    if ranker == "tfidf":
+        return frequencies / lengths
+    if ranker == "bm25":
+        return bm25_tf(frequencies, lengths, bm25)
+    raise ValueError(f"{ranker} is not an additive ranker")
+
+
+def block_bounds(ranker, weight, blocks, bm25=None):
+    ''' Upper bound of a term's weighted score in each of its blocks of postings, blocks comes from disk_index.blocks.
+    Exact bm25 block maxima are only stored for the default k1 and b, but bm25's tf only grows with frequency and shrinks
+    with length, so any other k1 and b is bounded by the block's highest frequency and shortest page '''
+    _, max_tfs, max_bm25_tfs, max_frequencies, min_lengths = blocks
+    if ranker == "tfidf":
+        return weight * max_tfs
+    if ranker == "bm25" and (bm25.k1, bm25.b) == (BM25_K1, BM25_B):
+        return weight * max_bm25_tfs
+    if ranker == "bm25":
+        return weight * bm25_tf(max_frequencies.astype(np.float64), min_lengths, bm25)
+    raise ValueError(f"{ranker} is not an additive ranker")
+
+
+def cosine_scores(doc_tf, query_terms, terms, idf):
+    doc_vectors = doc_tf * idf
+    query_vector = query_weights(query_terms, terms, idf)
+
+    dot_prods = doc_vectors @ query_vector
+    lengths = np.linalg.norm(doc_vectors, axis=1) * np.linalg.norm(query_vector)
+    simmilarity = np.divide(dot_prods, lengths, out=np.zeros_like(dot_prods), where=lengths > 0)
+    return simmilarity ** 1.2
+
+
+def base_scores(ranker, frequencies, lengths, query_terms, terms, idf, bm25=None):
+    ''' Scores of every page before the link_rank boost. frequencies has a row per page and lengths are the page lengths '''
+    if ranker == "cosine":
+        return cosine_scores(frequencies / lengths[:, None], query_terms, terms, idf)
+    if ranker in ADDITIVE_RANKERS:
+        return term_scores(ranker, frequencies, lengths[:, None], bm25) @ term_weights(ranker, query_terms, terms, idf)
+    raise ValueError(f"Unknown ranker {ranker}, expected one of {RANKERS}")
+
+
+def score_pages(pages, query_terms, terms, idf, k=TOP_K, ranker="cosine", bm25=None, boosts=None):
+    ''' Scores all candidate pages in one batch with the given ranker and multiplies that by the page rank and link_rank boosts.
+    terms are the unique query terms in column order and idf their idf values (bm25_idf for bm25, which also needs bm25_params).
+    boosts optionally has a multiplier for every page's base score, like positions.proximity_boosts.
+    Returns the k best pages as [page_url, score, [base_score, l_rank, rank_boost]], best first. '''
+    usable = pages.lengths > 0 # pages indexed before page lengths were stored
+    if not query_terms or not usable.any():
+        return []
+
+    keys = pages.keys[usable]
+    scores = base_scores(ranker, pages.frequencies[usable], pages.lengths[usable], query_terms, terms, idf, bm25)
+    if boosts is not None:
+        scores = scores * boosts[usable]
+    rank_boosts = page_rank_boosts(pages.ranks[usable])
+    ranked_scores = scores * rank_boosts
+
+    # link_rank can raise a score by at most max_boost, so only pages that could still reach the k-th best score with
+    # the full boost need their url looked up
+    max_boost = 1 + LINK_RANK_BOOST * len(query_terms)
+    if len(scores) > k:
+        threshold = np.partition(ranked_scores, -k)[-k]
+        shortlist = np.flatnonzero(ranked_scores * max_boost >= threshold)
+    else:
+        shortlist = np.arange(len(scores))
+
+    urls = [pages.get_url(key) for key in keys[shortlist].tolist()]
+    l_rank = 1 + link_ranks(urls, query_terms)
+    final_scores = ranked_scores[shortlist] * l_rank
+
+    return [[urls[i], float(final_scores[i]), [float(scores[shortlist[i]]), float(l_rank[i]), float(rank_boosts[shortlist[i]])]]
+            for i in top_k(final_scores, k)]
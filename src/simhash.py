@@ -0,0 +1,113 @@
+from hashlib import blake2b
+from itertools import combinations
+
+import numpy as np
+
+SIMHASH_VERSION = 2 # fingerprints of other versions can't be compared, bump when simhash changes
+FINGERPRINT_BITS = 64
+MAX_DISTANCE = 6 # pages whose fingerprints differ in at most this many bits are near duplicates
+BLOCKS = 8
+BLOCK_BITS = FINGERPRINT_BITS // BLOCKS
+# MAX_DISTANCE differing bits change at most that many blocks, so near duplicates always have BLOCKS - MAX_DISTANCE blocks
+# in common. There is a table for every combination of that many blocks, keyed by their bits together.
+TABLES = list(combinations(range(BLOCKS), BLOCKS - MAX_DISTANCE))
+MIN_TERMS = 20 # pages with fewer terms than this are too short to fingerprint reliably
+
+BIT_SHIFTS = np.arange(FINGERPRINT_BITS, dtype=np.uint64)
+
+
+def term_hash(term):
+    ''' Stable 64 bit hash of a term, python's own hash changes between processes '''
+    return int.from_bytes(blake2b(term.encode(), digest_size=8).digest(), "little")
+
+
+def simhash(term_frequencies, hashes):
+    ''' SimHash of a page from its term : frequency dictionary. Every distinct term votes for each bit of its hash being
+    set or not, so pages sharing most of their terms end up with fingerprints a few bits apart. Votes are weighted by
+    1 + log(frequency): repeated terms count for more than a word changed here and there, but not so much that the
+    handful of words common to every page decide most bits (which is what weighting by the frequency itself does).
+    hashes is a term : term_hash cache, shared between pages. Returns a signed 64 bit int (to fit a BIGINT) or None for
+    pages that are too short. '''
+    if len(term_frequencies) < MIN_TERMS:
+        return None
+
+    term_hashes = np.array([hashes[term] if term in hashes else hashes.setdefault(term, term_hash(term)) for term in term_frequencies],
+                           dtype=np.uint64)
+    weights = 1 + np.log(np.fromiter(term_frequencies.values(), dtype=np.float64, count=len(term_frequencies)))
+    set_bits = ((term_hashes[:, None] >> BIT_SHIFTS) & np.uint64(1)).astype(bool)
+    votes = 2 * weights @ set_bits - weights.sum()
+
+    fingerprint = int(np.bitwise_or.reduce(np.left_shift(np.uint64(1), BIT_SHIFTS[votes > 0])))
+    return fingerprint - (1 << FINGERPRINT_BITS) if fingerprint >= 1 << (FINGERPRINT_BITS - 1) else fingerprint
+
+
+def table_keys(fingerprint):
+    ''' The (table number, bits of the table's blocks) keys a fingerprint is stored under '''
+    unsigned = fingerprint & ((1 << FINGERPRINT_BITS) - 1)
+    mask = (1 << BLOCK_BITS) - 1
+    blocks = [(unsigned >> (block * BLOCK_BITS)) & mask for block in range(BLOCKS)]
+    keys = []
+    for table, table_blocks in enumerate(TABLES):
+        key = 0
+        for block in table_blocks:
+            key = (key << BLOCK_BITS) | blocks[block]
+        keys.append((table, key))
+    return keys
+
+
+def distance(a, b):
+    return ((a ^ b) & ((1 << FINGERPRINT_BITS) - 1)).bit_count()
+
+
+class simhash_index:
+    ''' LSH tables of canonical pages' fingerprints. A near duplicate has the same key as its canonical page in at least
+    one table, so only the pages in the page's own buckets get compared. '''
+    def __init__(self):
+        self.fingerprints = {} # page_id : fingerprint
+        self.buckets = {} # (table, key) : [page_id]
+
+    def __len__(self):
+        return len(self.fingerprints)
+
+    def add(self, page_id, fingerprint):
+        self.remove(page_id)
+        self.fingerprints[page_id] = fingerprint
+        for key in table_keys(fingerprint):
+            self.buckets.setdefault(key, []).append(page_id)
+
+    def remove(self, page_id):
+        fingerprint = self.fingerprints.pop(page_id, None)
+        if fingerprint is None:
+            return
+        for key in table_keys(fingerprint):
+            bucket = self.buckets[key]
+            bucket.remove(page_id)
+            if not bucket:
+                del self.buckets[key]
+
+    def find(self, fingerprint, exclude=None):
+        ''' Returns the page_id of a canonical page within MAX_DISTANCE bits of fingerprint (the closest one), or None '''
+        best, best_key = None, (MAX_DISTANCE + 1, 0) # ties go to the lowest page_id
+        checked = set() # a close page is in several of the same buckets
+        for key in table_keys(fingerprint):
+            for page_id in self.buckets.get(key, ()):
+                if page_id == exclude or page_id in checked:
+                    continue
+                checked.add(page_id)
+                page_key = (distance(fingerprint, self.fingerprints[page_id]), page_id)
+                if page_key < best_key:
+                    best, best_key = page_id, page_key
+        return best
+
+    def check(self, page_id, fingerprint):
+        ''' Adds a page, returns the canonical page it is a near duplicate of (and then it isn't added) or None '''
+        if fingerprint is None:
+            self.remove(page_id) # its content changed to something too short to fingerprint
+            return None
+
+        canonical = self.find(fingerprint, exclude=page_id)
+        if canonical is None:
+            self.add(page_id, fingerprint)
+        else:
+            self.remove(page_id)
+        return canonical
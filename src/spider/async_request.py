@@ -2,24 +2,55 @@ import asyncio
 import aiohttp
 from time import perf_counter
 
-async def fetch(session: aiohttp.ClientSession, url: str, headers: dict, semaphore: asyncio.Semaphore):
+CHUNK_SIZE = 64 * 1024
+
+
+async def fetch(session: aiohttp.ClientSession, url: str, headers: dict, semaphore: asyncio.Semaphore, max_bytes: int = None, accept=None):
+    ''' Gets a url and streams its body in, up to max_bytes. accept is called with the headers before anything is read,
+        if it returns False the body is never downloaded. The body is kept as raw bytes, see decode_body. "truncated" is True
+        when the body went past max_bytes and got cut off, "skipped" is how many bytes weren't downloaded (if known). '''
     async with semaphore:
         try:
             t = perf_counter()
             async with session.get(url, allow_redirects=True, headers=headers) as response:
-                return {
+                result = {
                     "url" : url,
                     "ok" :  response.ok,
                     "status" : response.status,
                     "headers" : response.headers,
-                    "text" : await response.text(encoding='utf-8', errors='replace'),
+                    "body" : None,
+                    "charset" : response.charset,
+                    "truncated" : False,
+                    "skipped" : response.content_length or 0,
                     "received" : True
                 }
+                if accept is not None and not accept(response.headers):
+                    response.close() # drops the connection instead of reading the body to reuse it
+                    return result
+
+                body = bytearray()
+                async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                    body += chunk
+                    if max_bytes is not None and len(body) > max_bytes:
+                        del body[max_bytes:]
+                        result["truncated"] = True
+                        response.close()
+                        break
+
+                result["body"] = bytes(body)
+                result["skipped"] = max((response.content_length or 0) - len(body), 0)
+                return result
 
         except asyncio.TimeoutError as e:
             return {"url" : url, "received" : False}
-        
+
         except Exception as e:
             return {"url" : url, "received" : False}
 
-    
\ No newline at end of file
+
+def decode_body(body, charset=None):
+    ''' Decodes a body from fetch, with the charset the server sent or utf-8 '''
+    try:
+        return body.decode(charset or "utf-8", errors="replace")
+    except LookupError: # a charset python doesn't know
+        return body.decode("utf-8", errors="replace")
@@ -12,6 +12,7 @@ from spider.rate_limit import (rate_limiter, get_rate_limit_from_response,
 						get_rate_limit_from_robots, can_fetch)
 from spider.util import to_domain, silent_log
 from spider.async_request import fetch
+from spider.scheduler import host_scheduler
 
 import traceback
 
@@ -36,10 +37,17 @@ class webcrawler:
 		self.response_headers = {f'User-Agent': f'iSearchBot/1.0 (https://github.com/antwaves/iSearch; {email}) aiohttp/3.13.3',
 								'Accept-Language' : 'en-US,en;q=0.9', 'Accept' : '*/*', "Cache-Control" : "max-age=0"}		
 		self.max_response_size = 3 * 1024 * 1024  
+		self.bytes_read = 0
+		self.bytes_skipped = 0 # bytes of rejected or cut off responses that weren't downloaded, when the size was known
+		self.truncated = 0
 
 		self.rate_limiter = rate_limiter(session, self.response_headers)
 		self.request_semaphore = asyncio.Semaphore(350) # secondary limiter before the actual request pool limiter
 
+		self.scheduler = host_scheduler() # politeness is kept per host, one fetch at a time and spaced by the host's delay
+		self.max_scheduled = 20000 # urls waiting in the scheduler before the feeder stops taking more from the link queue
+		self.fetches_per_worker = 10
+
 
 
 	def still_running(self):
@@ -47,117 +55,89 @@ class webcrawler:
 
 
 	async def worker(self):
+		''' Runs fetches_per_worker fetch loops at once '''
+		await asyncio.gather(*(self.fetch_loop() for _ in range(self.fetches_per_worker)))
+
+
+	async def fetch_loop(self):
+		''' Takes the next ready host from the scheduler, fetches one of its urls and gives the host back with its delay '''
 		while self.still_running():
-			t = time.time()
-			p = await self.get_page()	
+			try:
+				host, url = await asyncio.wait_for(self.scheduler.get(), 5)
+			except asyncio.TimeoutError: # nothing to fetch, check if the crawl is over
+				continue
 
+			delay = 0
+			try:
+				delay = await self.get_page(host, url)
+			finally:
+				self.scheduler.release(host, delay)
 
-	async def get_page(self):
-		t = time.perf_counter()
 
-		urls = await self.link_queue.get()
-		if not urls:
-			self.link_queue.task_done()
-			return 
+	async def feeder(self):
+		''' Moves batches of links from the link queue into the scheduler, skipping links that were already crawled. Links of hosts
+			that have too many waiting go back into the link queue for a later shuffle instead of being dropped '''
+		while self.still_running():
+			if len(self.scheduler) >= self.max_scheduled:
+				await asyncio.sleep(0.1)
+				continue
 
-		to_remove = set()
-		for url in urls:
-			if url not in self.link_queue.seen_pages:
-				self.link_queue.seen_pages.add(url)
-			else:
-				to_remove.add(url)
+			try:
+				urls = await asyncio.wait_for(self.link_queue.get(), 5)
+			except asyncio.TimeoutError:
+				continue
 
-		for url in to_remove:
-			urls.remove(url)
+			overflow = []
+			for url in urls or ():
+				if url in self.link_queue.seen_pages:
+					continue
 
-		url_to_domain = {}
-		domain_to_urls = {}
+				domain = to_domain(url)
+				if domain == "https://" or domain == "http://": #invalid domain
+					continue
 
-		for url in urls:
-			domain = to_domain(url)
-			if domain == "https://" or domain == "http://": #invalid domain
-				continue
+				if not self.scheduler.add(domain, url):
+					overflow.append(url)
 
-			domain_to_urls.setdefault(domain, []).append(url)
-			url_to_domain[url] = domain 
-		urls = list(url_to_domain.keys())
-		domains = list(set(url_to_domain.values()))	
-	
+			if overflow:
+				self.link_queue.put(overflow)
+			self.link_queue.task_done()
+
+
+	async def get_page(self, host, url):
+		''' Fetches a url if robots.txt allows it and sends it to the parser. Returns the seconds to wait before fetching from
+			the host again '''
+		self.link_queue.seen_pages.add(url) # only once it's fetched, so urls still waiting at exit get crawled next run
 		try:
-			to_grab = [url for url in urls]
-			sleep_times = []
-
-			domain_sleep_times = {}
-			for domain in domains:
-				sleep_time = self.rate_limiter.get_sleep_time(domain)
-				if sleep_time * len(domain_to_urls[domain]) < 3: # not perfect, but works. ideally, shouldnt matter
-					sleep_times.append(sleep_time)
-					continue
-				
-				urls = domain_to_urls[domain]
-				for url in urls:
-					if url in to_grab:
-						to_grab.remove(url)			
-
-			if not to_grab or not sleep_times:
-				print("All objects had a long sleep time or something broke")
-				self.link_queue.task_done()
-				return 
-
-			sleep_time = max(sleep_times)
-			#print(f"Sleeping for {sleep_time}")
-			await asyncio.sleep(sleep_time)
-
-			robot_rules = await self.rate_limiter.check_robots_for_batch(domains, self.request_semaphore)
-			if not robot_rules:
-				self.link_queue.task_done()
+			robot_rules = await self.rate_limiter.check_robots_for_batch([host], self.request_semaphore)
+			if robot_rules is None:
 				print("Died at robot rules")
-				return
-
-			for url in urls:
-				domain = url_to_domain[url]
-				robot_rule = robot_rules[domain]
-				if not can_fetch(url, robot_rule) and url in to_grab:
-					to_grab.remove(url)
-	
-			try:
-				completed_responses = 0
-				responses = [asyncio.create_task(fetch(self.session, url, self.response_headers, self.request_semaphore)) for url in to_grab]
-
-				for task in asyncio.as_completed(responses):
-					response = await task
-					
-					if not response:
-						continue 
-
-					if not response['received'] or not self.is_response_good(response['headers']):
-						continue
-					
-					url = response['url']
-					domain = url_to_domain[url]
-					response_text = response['text']
-
-					self.rate_limiter.set_rate_limits(response, url, robot_rules[domain], domain)
-					await self.parse_queue.put(page_info(url, response_text))
-				
+				return 0
+
+			robot_rule = robot_rules.get(host)
+			if not can_fetch(url, robot_rule):
+				return 0
+
+			response = await fetch(self.session, url, self.response_headers, self.request_semaphore, self.max_response_size,
+				self.is_response_good) # bad responses are dropped from their headers, before the body is read
+			if not response or not response['received']:
+				return self.rate_limiter.get_sleep_time(host)
+
+			self.bytes_skipped += response['skipped']
+			self.rate_limiter.set_rate_limits(response, url, robot_rule, host) # before filtering, so 429s and 503s are respected too
+			if response['body'] is not None:
+				self.bytes_read += len(response['body'])
+				if response['truncated']: # over max_response_size without a Content-Length saying so
+					self.truncated += 1
+				else:
+					await self.parse_queue.put(page_info(url, response['body'], response['charset']))
 					self.crawled += 1
-					completed_responses += 1
-					#print(url)
-
-				if self.still_running():
-					print(f"Finished a batch with length {completed_responses}")
-					
-			except Exception as e:
-				print(f"Exception in get-page-request {e}")
-				silent_log(e, "get_page-request", [url, domain])
 
 		except Exception as e:
 			print(f"Exception in get_page {e}")
-			silent_log(e, "get_page", [url, domain])
-			return 
+			silent_log(e, "get_page", [url, host])
 
-		finally:
-			self.link_queue.task_done()
+		return self.rate_limiter.get_sleep_time(host)
 
 
 	def is_response_good(self, headers): 
@@ -197,6 +177,7 @@ class webcrawler:
 				print(f"{self.crawled} pages crawled")
 				r = self.rate_limiter
 				print(f"{(r.cache_hits / (r.cache_hits + r.cache_misses)) * 100}% cache hit rate")
-				print(f"{(r.block_rate / (r.block_rate + r.not_blocked_rate)) * 100}% blocked rate{'\n' * 3}")
+				print(f"{(r.block_rate / (r.block_rate + r.not_blocked_rate)) * 100}% blocked rate")
+				print(f"{self.bytes_read / 1e6:.1f}MB read, {self.bytes_skipped / 1e6:.1f}MB skipped, {self.truncated} pages cut off{'\n' * 3}")
 				print(f"Took {time.perf_counter() - t}")
 
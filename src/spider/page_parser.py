@@ -7,14 +7,16 @@ from concurrent.futures import ProcessPoolExecutor
 from selectolax.lexbor import LexborHTMLParser
 
 from spider.util import silent_log 
+from spider.async_request import decode_body
 
 class page_info:
-    def __init__(self, url, content):
+    def __init__(self, url, content, charset=None):
         self.url = url
-        self.content = content
+        self.content = content # raw bytes, decoded in the parse process
+        self.charset = charset
 
     def __repr__(self):
-        return f"{self.url} with a content character length of {len(self.content)}"
+        return f"{self.url} with a content length of {len(self.content)} bytes"
 
 
 class parser:
@@ -66,10 +68,13 @@ class parser:
 
     async def run_parse_page(self, page_info):
         run_loop = asyncio.get_running_loop()
-        return await run_loop.run_in_executor(self.executor, parse_page, page_info.content, page_info.url, self.adding_new_links)
+        return await run_loop.run_in_executor(self.executor, parse_page, page_info.content, page_info.url, self.adding_new_links,
+                                              page_info.charset)
 
 
-def parse_page(content, base_url: str, adding_new_links: bool):
+def parse_page(content, base_url: str, adding_new_links: bool, charset=None):
+    if isinstance(content, bytes):
+        content = decode_body(content, charset)
     tree = LexborHTMLParser(content)
 
     if not tree:
@@ -1,28 +1,29 @@
 import asyncio
-import urllib
-import urllib.robotparser
 from datetime import datetime, timedelta, timezone
 from email.utils import parsedate_to_datetime
 
 from spider.util import to_top_domain, lock, silent_log
-from spider.async_request import fetch
+from spider.async_request import fetch, decode_body
+from spider.robots import robots_cache, parse_robots, FAILED_TTL, ROBOTS_MAX_BYTES
 
 import time
 
 
 class robotsTxt:
-    def __init__(self, parser, rate_limit):
-        self.parser = parser
+    def __init__(self, rules, rate_limit):
+        self.rules = rules
         self.rate_limit = rate_limit
 
 
 class rate_limiter:
-    def __init__(self, session, headers):
+    def __init__(self, session, headers, robots_path="robots.db"):
         self.session = session
         self.headers = headers
+        self.agent = headers["User-Agent"].split("/")[0].lower() # product token robots.txt groups are matched against
 
         self.domain_wait_times = {}
-        self.domain_robot_rules = {}
+        self.robots = robots_cache(robots_path)
+        self.robots_fetches = {} # domain : task fetching its robots.txt, so concurrent checks share one request
 
         self.cache_hits = 0
         self.cache_misses = 0
@@ -30,69 +31,55 @@ class rate_limiter:
         self.block_rate = 0
         self.not_blocked_rate = 0
 
-    # use reppy?
 
     async def check_robots_for_batch(self, domains: list, request_semaphore: asyncio.Semaphore):
-        to_grab = []
         robot_rules = {} # domain : robot_rules
+        waiting = {} # domain : task
 
         for domain in domains:
-            if domain in self.domain_robot_rules.keys():
+            found, robot_rule = self.robots.get(domain)
+            if found:
                 self.cache_hits += 1
-                robot_rules[domain] = self.domain_robot_rules[domain]
+                robot_rules[domain] = robot_rule
                 continue
-            to_grab.append(domain)
+
             self.cache_misses += 1
-        
+            task = self.robots_fetches.get(domain)
+            if task is None:
+                task = asyncio.create_task(self.fetch_robots(domain, request_semaphore))
+                self.robots_fetches[domain] = task
+                task.add_done_callback(lambda _, domain=domain: self.robots_fetches.pop(domain, None))
+            waiting[domain] = task
+
         try:
-            robot_urls = [domain + "/robots.txt" for domain in to_grab]
-            response_grabs = [fetch(self.session, url, self.headers, request_semaphore) for url in robot_urls]
-            responses = await asyncio.gather(*response_grabs)
-
-            for response in responses:
-                domain = response['url'][:-len("/robots.txt")] # not hardcoding to make this easier to read
-                
-                if not response:
-                    continue
-
-                if 'ok' not in response.keys() or not response['ok']:
-                    self.block_rate += 1
-                    self.domain_robot_rules[domain] = None
-                    robot_rules[domain] = None
-                    continue
-                self.not_blocked_rate += 1
-
-                if not 'text' in response.keys():
-                    self.domain_robot_rules[domain] = None
-                    robot_rules[domain] = None
-                    continue
-
-                robots_text = response['text']
-                lines = robots_text.splitlines()
-                r_parser = urllib.robotparser.RobotFileParser()
-                r_parser.parse(lines)
-
-                crawl_delay = r_parser.crawl_delay(self.headers["User-Agent"])
-                request_rate = r_parser.request_rate(self.headers["User-Agent"])
-                if request_rate:
-                    request_rate = request_rate.seconds / request_rate.requests
-
-                if crawl_delay and request_rate:
-                    rate_limit = max(crawl_delay, request_rate)
-                elif crawl_delay or request_rate:
-                    rate_limit = crawl_delay if crawl_delay else request_rate
-                else:
-                    rate_limit = 0 #changed later
-
-                robot_rule = robotsTxt(r_parser, rate_limit)
-                self.domain_robot_rules[domain] = robot_rule
-                robot_rules[domain] = robot_rule
-            
+            results = await asyncio.gather(*(asyncio.shield(task) for task in waiting.values())) # one caller being cancelled doesn't cancel the fetch for the rest
+            robot_rules.update(zip(waiting.keys(), results))
             return robot_rules
                         
         except Exception as e:
             print(f"Robot parsing failed with exeception {e}")
-            silent_log(e, f"check_robots: {robot_urls}")
+            silent_log(e, f"check_robots: {list(waiting.keys())}")
+
+
+    async def fetch_robots(self, domain, request_semaphore):
+        ''' Fetches and parses a domain's robots.txt and caches it, returns its robotsTxt or None if there are no rules '''
+        response = await fetch(self.session, domain + "/robots.txt", self.headers, request_semaphore, ROBOTS_MAX_BYTES) # parses what fits
+
+        if not response.get('received'):
+            self.block_rate += 1
+            self.robots.set(domain, None, FAILED_TTL)
+            return None
+
+        if not response['ok'] or not response['body']:
+            self.block_rate += 1
+            self.robots.set(domain, None)
+            return None
+        self.not_blocked_rate += 1
+
+        rules, rate_limit = parse_robots(decode_body(response['body'], response['charset']), self.agent)
+        robot_rule = robotsTxt(rules, rate_limit or 0) # 0 is changed later
+        self.robots.set(domain, robot_rule)
+        return robot_rule
 
 
     def set_rate_limits(self, response, url, robot_rules, domain = None):
@@ -166,5 +153,5 @@ def get_rate_limit_from_robots(robot_rules):
     
 def can_fetch(url, robot_rules):
     if robot_rules:
-        return robot_rules.parser.can_fetch("*", url)
+        return robot_rules.rules.allowed(url)
     return True
@@ -0,0 +1,155 @@
+import pickle
+import re
+import sqlite3
+import time
+from collections import OrderedDict
+from urllib.parse import quote, unquote, urlsplit
+
+ROBOTS_TTL = 24 * 60 * 60 # robots.txt shouldn't be cached for longer than a day
+FAILED_TTL = 60 * 60 # hosts whose robots.txt couldn't be fetched are tried again sooner
+MEMORY_ROBOTS = 50000 # hosts kept in memory, the rest are read back from disk when needed
+ROBOTS_MAX_BYTES = 500 * 1024 # robots.txt is cut off after this, RFC 9309 asks for parsing at least 500 KiB
+
+SAFE_CHARACTERS = "/?=&;:@+,!~'()*$"
+NEEDS_QUOTING = re.compile(r"[^A-Za-z0-9_.\-/?=&;:@+,!~'()*$]")
+
+
+def normalize(path):
+    ''' Percent-encodes a path the same way for rules and urls, so /a%7Eb and /a~b match each other '''
+    if not NEEDS_QUOTING.search(path): # most paths, quote is slow
+        return path
+    return quote(unquote(path), safe=SAFE_CHARACTERS)
+
+
+class robots_rules:
+    ''' The allow and disallow rules for one user agent, compiled for matching. Plain rules are prefix checks, rules with
+    * or $ become regexes. The longest matching rule decides, and allow wins a tie. '''
+    def __init__(self, rules):
+        self.rules = [] # (length, allowed, prefix, regex or None), longest first
+        for allowed, path in rules:
+            path = normalize(path)
+            if "*" in path or path.endswith("$"):
+                anchored = path.endswith("$")
+                body = path[:-1] if anchored else path
+                regex = re.compile(".*".join(re.escape(part) for part in body.split("*")) + ("$" if anchored else ""))
+                self.rules.append((len(path), allowed, None, regex))
+            else:
+                self.rules.append((len(path), allowed, path, None))
+        self.rules.sort(key=lambda rule: (-rule[0], not rule[1]))
+
+        self.allows_all = all(allowed for _, allowed, _, _ in self.rules)
+
+    def allowed(self, url):
+        if self.allows_all:
+            return True
+
+        parts = urlsplit(url)
+        path = normalize(parts.path or "/") + ("?" + parts.query if parts.query else "")
+        if path == "/robots.txt":
+            return True
+
+        for _, allowed, prefix, regex in self.rules:
+            if regex is None:
+                if path.startswith(prefix):
+                    return allowed
+            elif regex.match(path):
+                return allowed
+        return True
+
+
+def parse_robots(text, agent):
+    ''' Parses robots.txt for the agent (a lowercase product token like "isearchbot"). Uses the groups naming the agent,
+    or the * groups when none do. Returns (robots_rules, crawl delay or request rate in seconds or None). '''
+    groups = [] # (agents, rules, delay)
+    agents, rules, delay = [], [], None
+    in_rules = False
+
+    for line in text.splitlines():
+        line = line.split("#", 1)[0].strip()
+        if ":" not in line:
+            continue
+        field, value = line.split(":", 1)
+        field, value = field.strip().lower(), value.strip()
+
+        if field == "user-agent":
+            if in_rules: # a user-agent line after rules starts a new group
+                groups.append((agents, rules, delay))
+                agents, rules, delay = [], [], None
+                in_rules = False
+            agents.append(value.lower())
+            continue
+
+        if not agents: # rules before any user-agent line belong to nobody
+            continue
+        in_rules = True
+
+        if field in ("allow", "disallow") and value:
+            rules.append((field == "allow", value))
+        elif field == "crawl-delay":
+            try:
+                delay = max(delay or 0, float(value))
+            except ValueError:
+                pass
+        elif field == "request-rate":
+            try:
+                requests, seconds = value.split("/")
+                delay = max(delay or 0, int(seconds) / int(requests))
+            except (ValueError, ZeroDivisionError):
+                pass
+    if agents:
+        groups.append((agents, rules, delay))
+
+    matched = [group for group in groups if any(name != "*" and name in agent for name in group[0])]
+    if not matched:
+        matched = [group for group in groups if "*" in group[0]]
+
+    rules = [rule for group in matched for rule in group[1]]
+    delays = [group[2] for group in matched if group[2] is not None]
+    return robots_rules(rules), max(delays) if delays else None
+
+
+class robots_cache:
+    ''' Parsed robots.txt of every host, kept in a SQLite file so they survive restarts. The MEMORY_ROBOTS most recently
+    used ones are also kept in memory. Entries expire after their ttl. '''
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS robots (host TEXT PRIMARY KEY, expires_at REAL NOT NULL, rules BLOB)")
+        self.db.execute("DELETE FROM robots WHERE expires_at < ?", (time.time(),))
+        self.db.commit()
+
+        self.memory = OrderedDict() # host : (expires_at, robotsTxt or None)
+
+    def get(self, host):
+        ''' Returns (found, robotsTxt or None) '''
+        entry = self.memory.get(host)
+        if entry is None:
+            row = self.db.execute("SELECT expires_at, rules FROM robots WHERE host = ?", (host,)).fetchone()
+            if row is None:
+                return False, None
+            entry = (row[0], pickle.loads(row[1]) if row[1] is not None else None)
+            self.remember(host, entry)
+
+        if entry[0] < time.time():
+            self.memory.pop(host, None)
+            return False, None
+
+        self.memory.move_to_end(host)
+        return True, entry[1]
+
+    def set(self, host, robot_rule, ttl=ROBOTS_TTL):
+        entry = (time.time() + ttl, robot_rule)
+        self.remember(host, entry)
+        blob = pickle.dumps(robot_rule, protocol=pickle.HIGHEST_PROTOCOL) if robot_rule is not None else None
+        self.db.execute("INSERT OR REPLACE INTO robots (host, expires_at, rules) VALUES (?, ?, ?)", (host, entry[0], blob))
+        self.db.commit()
+
+    def remember(self, host, entry):
+        self.memory[host] = entry
+        self.memory.move_to_end(host)
+        if len(self.memory) > MEMORY_ROBOTS:
+            self.memory.popitem(last=False)
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,118 @@
+import asyncio
+import heapq
+import itertools
+import time
+from collections import deque
+
+
+class host_scheduler:
+    ''' Hands out urls one host at a time. Every host with waiting urls sits in a min-heap keyed by the monotonic time it
+    may be fetched from again, and a host that was handed out stays out of the heap until it is released with its next
+    delay. So each host gets at most one fetch at a time, spaced by its own delay, while other hosts keep going. '''
+
+    def __init__(self, max_host_urls=500):
+        self.max_host_urls = max_host_urls # urls waiting per host, add refuses more so one host can't fill the scheduler
+
+        self.host_urls = {} # host : deque of urls waiting
+        self.queued = set() # every url waiting, so one isn't queued twice
+        self.ready_at = {} # host : monotonic time it may be fetched from again
+        self.idle = [] # (ready time, host) min-heap of released hosts without urls, to drop their ready_at once it passes
+        self.heap = [] # (ready time, tiebreaker, host) for every host with urls that isn't being fetched from
+        self.active = set() # hosts handed out and not released yet
+        self.counter = itertools.count()
+        self.waiters = deque() # futures of get calls waiting for a host
+
+        self.pending = 0 # urls waiting in total
+
+
+    def __len__(self):
+        return self.pending
+
+
+    def urls(self):
+        ''' Every url still waiting, for saving them when the crawl stops '''
+        return [url for urls in self.host_urls.values() for url in urls]
+
+
+    def add(self, host, url):
+        ''' Queues a url under its host (if it isn't already), returns False if the host already has max_host_urls waiting '''
+        if url in self.queued:
+            return True
+
+        urls = self.host_urls.setdefault(host, deque())
+        if len(urls) >= self.max_host_urls:
+            return False
+
+        urls.append(url)
+        self.queued.add(url)
+        self.pending += 1
+        if len(urls) == 1 and host not in self.active:
+            self.schedule(host)
+        return True
+
+
+    def schedule(self, host):
+        heapq.heappush(self.heap, (self.ready_at.get(host, 0), next(self.counter), host))
+        self.wake()
+
+
+    def wake(self):
+        ''' Wakes up one waiting get, to check the top of the heap again '''
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+
+
+    async def get(self):
+        ''' Waits for the host that is ready first and returns (host, its next url). The host has to be released after. '''
+        while True:
+            wait = None
+            if self.heap:
+                wait = self.heap[0][0] - time.monotonic()
+                if wait <= 0:
+                    _, _, host = heapq.heappop(self.heap)
+                    url = self.host_urls[host].popleft()
+                    self.queued.discard(url)
+                    self.pending -= 1
+                    self.active.add(host)
+                    if self.heap: # the next host might be ready too
+                        self.wake()
+                    return host, url
+
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters.append(waiter)
+            try:
+                await asyncio.wait_for(waiter, wait)
+            except asyncio.TimeoutError: # the top host became ready
+                pass
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled(): # pass the wake up on instead of losing it
+                    self.wake()
+                raise
+
+
+    def release(self, host, delay=0):
+        ''' Gives a host back after fetching from it, it can be fetched from again after delay seconds '''
+        self.active.discard(host)
+        self.ready_at[host] = time.monotonic() + delay
+        if self.host_urls.get(host):
+            self.schedule(host)
+        else:
+            self.host_urls.pop(host, None)
+            if delay <= 0:
+                self.ready_at.pop(host, None)
+            else:
+                heapq.heappush(self.idle, (self.ready_at[host], host))
+        self.forget_idle()
+
+
+    def forget_idle(self):
+        ''' Drops the ready_at of hosts without urls whose delay has passed, it doesn't matter anymore and a host that
+        never gets another url would keep it forever '''
+        now = time.monotonic()
+        while self.idle and self.idle[0][0] <= now:
+            ready, host = heapq.heappop(self.idle)
+            if host not in self.host_urls and host not in self.active and self.ready_at.get(host) == ready:
+                del self.ready_at[host]
@@ -36,6 +36,7 @@ class spider:
 	def create_workers(self, crawl_worker_num, parse_worker_num, database_worker_num):
 		'''Creates workers for crawling, parsing and database handling. Also  '''
 		self.crawl_workers.append(asyncio.create_task(self.crawl_handler.shuffle_handler()))
+		self.crawl_workers.append(asyncio.create_task(self.crawl_handler.feeder()))
 		self.crawl_workers.extend([asyncio.create_task(self.crawl_handler.worker()) for _ in range(crawl_worker_num)])
 		self.parse_workers = [asyncio.create_task(self.parse_handler.worker()) for _ in range(parse_worker_num)]
 		self.database_workers = [asyncio.create_task(self.database_handler.worker()) for _ in range(database_worker_num)]
@@ -68,6 +69,9 @@ class spider:
 				await asyncio.gather(*self.crawl_workers, *self.parse_workers, *self.database_workers, self.worker_manager)
 			except asyncio.CancelledError:
 				pass    
+			finally:
+				#keep the links that weren't crawled for the next run
+				self.link_queue.save(self.crawl_handler.scheduler.urls())
 	
 	
 	async def manager(self):
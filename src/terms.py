@@ -0,0 +1,36 @@
+import re
+
+PUNCTUATION = {'.': ' ', '?': ' ', '!': ' ', ',': ' ',
+               ':': ' ', ';': ' ', '—': ' ', '(': ' ', ')': ' ',
+               '[': ' ', ']': ' ', '{': ' ', '}': ' ', '\\': ' ', "'": ' ',
+               '"': ' ', '/': ' ', '*': ' ', '&': ' ', '~': ' ', '+': ' '}
+TRANSLATOR = str.maketrans(PUNCTUATION)
+TERM_FINDER = re.compile(r"[A-Za-z0-9_\-#@]+")
+VOWELS = "aeiouy"
+
+
+def split_terms(text):
+    ''' Every word of a text, lowercased. Characters that aren't ascii are dropped first, so naïve is read as nave '''
+    text = text.encode("ascii", "ignore").decode().translate(TRANSLATOR)
+    return [term.lower() for term in TERM_FINDER.findall(text)]
+
+
+def index_terms(text, stopwords):
+    ''' The words of a text the indexer keeps, in order. Stopwords, single letters, very long words and long ones that
+    look like random strings are left out. Used for page content and for quoted phrases, so both see the same terms '''
+    terms = []
+    for term in split_terms(text):
+        if term in stopwords:
+            continue
+
+        length = len(term)
+        if length <= 1 or length >= 30:
+            continue
+
+        if length > 20:
+            vowel_amount = sum(char in VOWELS for char in term)
+            if vowel_amount > 7 and vowel_amount + 1 < length // 2:
+                continue
+
+        terms.append(term)
+    return terms
@@ -0,0 +1,92 @@
+import math
+import os
+import pickle
+from hashlib import blake2b
+
+GROWTH = 2 # every new filter holds this many times more urls than the last
+TIGHTENING = 0.8 # and has this times the error rate, so the total false positive rate stays under error_rate
+
+
+def url_hashes(url):
+    ''' Two 64 bit hashes of a url, every bit position a filter checks is made from them (double hashing) '''
+    digest = blake2b(url.encode(), digest_size=16).digest()
+    return int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+
+
+class bloom_filter:
+    ''' Fixed size Bloom filter, holds capacity urls at error_rate false positives '''
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.bit_amount = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hash_amount = max(1, round(self.bit_amount / capacity * math.log(2)))
+        self.bits = bytearray((self.bit_amount + 7) // 8)
+        self.count = 0
+
+    def positions(self, hashes):
+        h1, h2 = hashes
+        return [(h1 + i * h2) % self.bit_amount for i in range(self.hash_amount)]
+
+    def contains(self, hashes):
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self.positions(hashes))
+
+    def add(self, hashes):
+        bits = self.bits
+        for position in self.positions(hashes):
+            bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+
+class seen_filter:
+    ''' Set of urls that were already crawled, as a scalable Bloom filter: once a filter is full a bigger one is added
+    after it, until max_bytes is used up. Past that the oldest filters are dropped to make room for one as big as the
+    last, so the false positive rate stays under error_rate but the urls in them can be crawled again. A false positive
+    means a url is skipped. '''
+    def __init__(self, capacity=1_000_000, error_rate=0.001, max_bytes=256 * 1024 * 1024):
+        self.error_rate = error_rate
+        self.max_bytes = max_bytes
+        self.filters = [bloom_filter(capacity, error_rate * (1 - TIGHTENING))]
+
+    def __len__(self):
+        return sum(bloom.count for bloom in self.filters)
+
+    def __contains__(self, url):
+        hashes = url_hashes(url)
+        return any(bloom.contains(hashes) for bloom in self.filters)
+
+    def nbytes(self):
+        return sum(len(bloom.bits) for bloom in self.filters)
+
+    def add(self, url):
+        hashes = url_hashes(url)
+        if any(bloom.contains(hashes) for bloom in self.filters):
+            return
+
+        last = self.filters[-1]
+        if last.count >= last.capacity:
+            error_rate = self.error_rate * (1 - TIGHTENING) * TIGHTENING ** len(self.filters)
+            bloom = bloom_filter(last.capacity * GROWTH, error_rate)
+            if self.nbytes() + len(bloom.bits) > self.max_bytes:
+                bloom = bloom_filter(last.capacity, last.error_rate)
+                while self.filters and self.nbytes() + len(bloom.bits) > self.max_bytes:
+                    oldest = self.filters.pop(0)
+                    print(f"Seen url filter is at its {self.max_bytes} byte limit, forgetting {oldest.count} crawled urls, they can be crawled again")
+            self.filters.append(bloom)
+            last = bloom
+        last.add(hashes)
+
+    def save(self, path):
+        ''' Writes the filter to path, through a temporary file so a crash can't leave half of one behind '''
+        temp_path = path + ".tmp"
+        with open(temp_path, "wb") as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, path)
+
+
+def load_seen_filter(path, **kwargs):
+    ''' Reads a filter saved with seen_filter.save, or makes a new one with kwargs if path doesn't exist '''
+    if not os.path.exists(path):
+        return seen_filter(**kwargs)
+    with open(path, "rb") as f:
+        return pickle.load(f)
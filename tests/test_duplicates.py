@@ -0,0 +1,85 @@
+import asyncio
+import os
+import random
+
+import pytest
+
+# runs the indexer against a real database, TEST_DBNAME names a throwaway one (its public schema gets dropped), the
+# rest of the connection comes from the same USER, PASSWORD, HOST and PORT settings as the indexer
+pytest.importorskip("asyncpg")
+if not os.getenv("TEST_DBNAME"):
+    pytest.skip("TEST_DBNAME isn't set", allow_module_level=True)
+
+import sqlalchemy as sa
+
+import db
+import indexer
+
+SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+WORDS = [f"word{i}" for i in range(5000)]
+
+
+def page_text(seed):
+    rng = random.Random(seed)
+    return " ".join(rng.choice(WORDS) for _ in range(300))
+
+
+async def reset_database():
+    session_maker = await db.connect_to_db(4)
+    async with session_maker() as session:
+        await session.execute(sa.text("DROP SCHEMA public CASCADE"))
+        await session.execute(sa.text("CREATE SCHEMA public"))
+        await session.commit()
+    return await db.connect_to_db(4)
+
+
+async def run_incremental():
+    handler = indexer.index_handler(2, index_path=None, incremental=True)
+    try:
+        await handler.run_indexer()
+    finally:
+        handler.pool.shutdown()
+
+
+async def page_state(session_maker, page_id):
+    async with session_maker() as session:
+        duplicate_of, indexed_at, page_length = (await session.execute(
+            sa.select(db.Page.duplicate_of, db.Page.indexed_at, db.Page.page_length).where(db.Page.page_id == page_id))).one()
+        links = (await session.execute(sa.text("SELECT count(*) FROM public.term_page_links WHERE page_id = :page_id"),
+                                       {"page_id": page_id})).scalar()
+    return duplicate_of, indexed_at, page_length, links
+
+
+def test_duplicates_are_checked_again_when_their_canonical_page_changes(monkeypatch):
+    monkeypatch.setenv("DBNAME", os.environ["TEST_DBNAME"])
+    monkeypatch.chdir(SRC) # for stopwords.txt
+
+    async def sequence():
+        session_maker = await reset_database()
+        async with session_maker() as session:
+            await session.execute(sa.insert(db.Page), [
+                {"page_id": 1, "page_url": "https://a.com/", "page_content": page_text(1)},
+                {"page_id": 2, "page_url": "https://b.com/", "page_content": page_text(1)}, # a copy of page 1
+                {"page_id": 3, "page_url": "https://c.com/", "page_content": page_text(3)},
+            ])
+            await session.commit()
+
+        await run_incremental()
+        duplicate_of, indexed_at, page_length, links = await page_state(session_maker, 2)
+        assert duplicate_of == 1 and indexed_at is not None and page_length is None and links == 0
+
+        async with session_maker() as session: # page 1 is re-crawled with new content, page 2 stays the same
+            await session.execute(sa.update(db.Page).where(db.Page.page_id == 1)
+                                  .values(page_content=page_text(4), content_updated=sa.func.now()))
+            await session.commit()
+
+        await run_incremental()
+        assert (await page_state(session_maker, 1))[3] > 0
+        assert (await page_state(session_maker, 2))[1] is None # waiting to be checked again
+
+        await run_incremental()
+        duplicate_of, indexed_at, page_length, links = await page_state(session_maker, 2)
+        assert duplicate_of is None and indexed_at is not None and page_length and links > 0
+        assert (await page_state(session_maker, 3))[0] is None
+
+    asyncio.run(sequence())
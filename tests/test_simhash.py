@@ -0,0 +1,89 @@
+from collections import Counter
+import random
+
+import numpy as np
+
+from simhash import MAX_DISTANCE, distance, simhash, simhash_index, table_keys
+
+VOCABULARY = [f"term{i}" for i in range(50000)]
+ZIPF = np.cumsum(1 / np.arange(1, len(VOCABULARY) + 1)) # word frequencies in text fall off like 1 / rank
+ZIPF /= ZIPF[-1]
+
+
+def random_words(rng, amount):
+    return [VOCABULARY[i] for i in np.searchsorted(ZIPF, rng.random(amount))]
+
+
+def change_words(rng, words, fraction):
+    ''' Replaces fraction of the words of a page with random words '''
+    words = list(words)
+    positions = rng.choice(len(words), max(1, int(len(words) * fraction)), replace=False)
+    for position, word in zip(positions, random_words(rng, len(positions))):
+        words[position] = word
+    return words
+
+
+def fingerprint(words, hashes):
+    return simhash(Counter(words), hashes)
+
+
+def make_pages(seed, amount=300):
+    rng = np.random.default_rng(seed)
+    return rng, [random_words(rng, int(rng.integers(150, 1500))) for _ in range(amount)]
+
+
+def recall(fraction, seed):
+    ''' Share of pages with fraction of their words changed that are found as near duplicates of the original '''
+    rng, pages = make_pages(seed)
+    hashes = {}
+    index = simhash_index()
+    for page_id, words in enumerate(pages):
+        index.add(page_id, fingerprint(words, hashes))
+
+    found = [index.find(fingerprint(change_words(rng, words, fraction), hashes)) == page_id for page_id, words in enumerate(pages)]
+    return sum(found) / len(found)
+
+
+def test_recall_of_changed_pages():
+    assert recall(0.01, seed=1) >= 0.97
+    assert recall(0.02, seed=2) >= 0.9
+
+
+def test_unrelated_pages_are_not_duplicates():
+    rng, pages = make_pages(3)
+    topic = [f"topic{i}" for i in range(300)]
+    for words in pages[:100]: # a third of the words from the same small vocabulary, like pages of one site
+        words[:len(words) // 3] = [topic[i] for i in rng.integers(0, len(topic), len(words) // 3)]
+
+    hashes = {}
+    index = simhash_index()
+    duplicates = [index.check(page_id, fingerprint(words, hashes)) for page_id, words in enumerate(pages)]
+    assert duplicates == [None] * len(pages)
+
+
+def test_close_fingerprints_share_a_table_key():
+    rng = random.Random(4)
+    for _ in range(2000):
+        a = rng.getrandbits(64)
+        b = a
+        for bit in rng.sample(range(64), rng.randint(0, MAX_DISTANCE)):
+            b ^= 1 << bit
+        assert distance(a, b) <= MAX_DISTANCE
+        assert set(table_keys(a)) & set(table_keys(b))
+
+
+def test_short_pages_have_no_fingerprint():
+    index = simhash_index()
+    assert fingerprint(["term1", "term2"] * 50, {}) is None
+    assert index.check(1, None) is None
+    assert len(index) == 0
+
+
+def test_check_keeps_the_first_copy():
+    _, pages = make_pages(5, amount=3)
+    hashes = {}
+    index = simhash_index()
+    assert index.check(10, fingerprint(pages[0], hashes)) is None
+    assert index.check(11, fingerprint(pages[0], hashes)) == 10
+    assert index.check(12, fingerprint(pages[1], hashes)) is None
+    assert len(index) == 2